@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from pathlib import Path
+
+from PIL import Image, ImageFont
+
+from template_compiler import CANVAS_SIZE, RenderPlan, compile_template, font_file, register_font
+from template_registry import TemplateRegistry
+
+log = logging.getLogger(__name__)
+
+# Формат файла: MAGIC, длина заголовка (8 байт), JSON заголовок, данные
+MAGIC = b'FUNNELBUNDLE1\n'
+_LENGTH = struct.Struct('<Q')
+
+
+def template_hash(html):
+    """Ключ шаблона в пакете: sha256 содержимого"""
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+
+def _plan_fonts(plan):
+    """(font-family, жирный) персональных строк плана: им нужен шрифт при отрисовке"""
+    fonts = set()
+    for runs, _, _ in plan.dynamic_lines:
+        for run in runs:
+            if run[0] == 'text':
+                fonts.add((run[2][0], bool(run[2][1])))
+    return fonts
+
+
+def build_bundle(templates_dir, output, render_version, size=CANVAS_SIZE):
+    """Компилирует шаблоны этапов и пишет пакет ресурсов
+
+    В пакете — статичный слой каждого этапа (несжатый RGB, чтобы отдавать
+    его из mmap без декодирования), разложенные персональные строки и файлы
+    шрифтов, которые для них нашлись на этой машине.
+    """
+    registry = TemplateRegistry(templates_dir)
+    blobs = []
+    offset = 0
+
+    def add_blob(data):
+        nonlocal offset
+        blobs.append(data)
+        offset += len(data)
+        return [offset - len(data), len(data)]
+
+    stages = {}
+    fonts = {}
+    font_files = {}
+    for stage in registry.stages:
+        html = registry.get(stage)
+        plan = compile_template(html, size)
+        stages[template_hash(html)] = {
+            'stage': stage,
+            'layer': add_blob(plan.static_layer.tobytes()),
+            'dynamic_lines': [
+                [[list(run) for run in runs], baseline, max_width]
+                for runs, baseline, max_width in plan.dynamic_lines
+            ],
+        }
+        for family, bold in _plan_fonts(plan):
+            path = font_file(family, bold)
+            if path is None:
+                continue
+            # Один файл шрифта на все семейства, которые на него указывают
+            if path not in font_files:
+                font_files[path] = add_blob(_read_font(path))
+            fonts[f"{int(bold)}:{family}"] = font_files[path]
+
+    header = json.dumps({
+        'render_version': render_version,
+        'size': list(size),
+        'stages': stages,
+        'fonts': fonts,
+    }, ensure_ascii=False).encode('utf-8')
+    output = Path(output)
+    tmp_path = output.with_name(output.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_LENGTH.pack(len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, output)
+    return len(stages), len(font_files), output.stat().st_size
+
+
+def _read_font(path):
+    """Содержимое файла шрифта; имя без каталога ищется так же, как при отрисовке"""
+    return Path(ImageFont.truetype(path, 10).path).read_bytes()
+
+
+class AssetBundle:
+    """Пакет ресурсов, отображенный в память (mmap)
+
+    Файл не читается целиком: план этапа собирается при первом обращении,
+    а его статичный слой ссылается прямо на страницы mmap, общие для всех
+    процессов на машине. Шаблон, измененный после сборки пакета, в нем не
+    найдется — такой этап компилируется как обычно.
+    """
+
+    def __init__(self, path, render_version):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._map[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{self.path} is not an asset bundle")
+            start = len(MAGIC) + _LENGTH.size
+            (length,) = _LENGTH.unpack_from(self._map, len(MAGIC))
+            self._header = json.loads(self._map[start:start + length])
+        except Exception:
+            self._file.close()
+            raise
+        self._data_start = start + length
+        self.size = tuple(self._header['size'])
+        # Пакет, собранный другой версией отрисовки, не используется
+        self.valid = self._header['render_version'] == render_version
+        self._plans = {}
+        self._fonts_registered = False
+
+    @classmethod
+    def from_env(cls, render_version):
+        """Открывает пакет из ASSET_BUNDLE (по умолчанию assets.bundle); None, если его нет"""
+        path = Path(os.getenv("ASSET_BUNDLE", "assets.bundle"))
+        if not path.exists():
+            return None
+        try:
+            bundle = cls(path, render_version)
+        except (OSError, ValueError) as e:
+            log.warning("⚠️ Пакет ресурсов %s не загружен: %s", path, e)
+            return None
+        if not bundle.valid:
+            log.warning("⚠️ Пакет ресурсов %s собран для другой версии отрисовки, пересоберите его", path)
+            return None
+        return bundle
+
+    def __len__(self):
+        return len(self._header['stages'])
+
+    def _view(self, blob):
+        offset, length = blob
+        start = self._data_start + offset
+        return memoryview(self._map)[start:start + length]
+
+    def register_fonts(self):
+        """Передает шрифты пакета отрисовке вместо поиска файлов на диске"""
+        if self._fonts_registered:
+            return
+        for key, blob in self._header['fonts'].items():
+            bold, family = key.split(':', 1)
+            register_font(family, bold == '1', bytes(self._view(blob)))
+        self._fonts_registered = True
+
+    def plan(self, html, size=CANVAS_SIZE):
+        """RenderPlan шаблона из пакета или None, если шаблона в нем нет"""
+        key = template_hash(html)
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+        entry = self._header['stages'].get(key)
+        if entry is None or tuple(size) != self.size:
+            return None
+        self.register_fonts()
+        layer = Image.frombuffer('RGB', self.size, self._view(entry['layer']), 'raw', 'RGB', 0, 1)
+        dynamic_lines = [
+            (
+                [
+                    ('text', run[1], (run[2][0], bool(run[2][1]), run[2][2]), tuple(run[3]))
+                    if run[0] == 'text' else ('gap', run[1])
+                    for run in runs
+                ],
+                baseline,
+                max_width,
+            )
+            for runs, baseline, max_width in entry['dynamic_lines']
+        ]
+        plan = self._plans[key] = RenderPlan(self.size, layer, dynamic_lines)
+        return plan
+
+
+if __name__ == "__main__":
+    # python asset_bundle.py [templates] [assets.bundle] — шаг сборки перед деплоем
+    from funnel_bot import RENDER_VERSION
+
+    templates_dir = sys.argv[1] if len(sys.argv) > 1 else "templates"
+    output = sys.argv[2] if len(sys.argv) > 2 else os.getenv("ASSET_BUNDLE", "assets.bundle")
+    stages, fonts, size = build_bundle(templates_dir, output, RENDER_VERSION)
+    print(f"✓ Пакет ресурсов {output}: этапов {stages}, шрифтов {fonts}, {size // 1024} КБ")
@@ -0,0 +1,332 @@
+"""Бенчмарки рендеринга, хранилища и полного пути обработчиков
+
+    python benchmark.py                              # все группы
+    python benchmark.py --only store --sizes 1000,100000
+    python benchmark.py --output results.json        # сохранить результаты
+    python benchmark.py --compare old.json           # сравнить с прошлым запуском
+
+Результаты — JSON: версия, коммит и для каждого бенчмарка статистика
+времени одной операции в миллисекундах.
+"""
+import argparse
+import asyncio
+import contextlib
+import csv
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent
+# Рендер в потоках: измеряем саму работу, а не запуск процессов
+os.environ.setdefault("RENDER_EXECUTOR", "thread")
+
+import funnel_bot
+from funnel_bot import FunnelBot, ImageEncoder
+from perf_report import run_info, summarize
+from template_compiler import compile_template
+from user_store import CSV_FIELDS, CachedUserStore, CsvUserStore, SqliteUserStore
+
+RESULTS_VERSION = 1
+
+# Отклонение медианы, которое считается регрессией при сравнении
+REGRESSION_THRESHOLD = 0.10
+
+
+def measure(func, min_time=0.5, min_runs=5, max_runs=10000):
+    """Вызывает func() пока не наберется min_time секунд и min_runs замеров"""
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_runs and (
+        len(samples) < min_runs or time.perf_counter() - started < min_time
+    ):
+        t0 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples)
+
+
+async def measure_async(func, min_time=0.5, min_runs=5, max_runs=10000):
+    """Как measure, но для корутин"""
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_runs and (
+        len(samples) < min_runs or time.perf_counter() - started < min_time
+    ):
+        t0 = time.perf_counter()
+        await func()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Отключает логи бота во время замеров"""
+    logging.disable(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def bench_render(results, args):
+    """Компиляция шаблона, отрисовка имени и кодирование для каждого этапа"""
+    bot = FunnelBot()
+    encoders = [ImageEncoder('JPEG'), ImageEncoder('PNG'), ImageEncoder('WEBP')]
+    for stage in bot.templates.stages:
+        html = bot.load_template(stage)
+        results[f'render.compile.stage{stage}'] = measure(
+            lambda: compile_template(html), args.min_time
+        )
+        plan = compile_template(html)
+        names = iter(f"Пользователь {i}" for i in range(10 ** 9))
+        results[f'render.draw.stage{stage}'] = measure(
+            lambda: plan.render(next(names)), args.min_time
+        )
+        img = plan.render("Александра")
+        for encoder in encoders:
+            results[f'render.encode.{encoder.format.lower()}.stage{stage}'] = measure(
+                lambda: encoder.encode(img), args.min_time
+            )
+        # Путь воркера пула: план из памяти + отрисовка + кодирование
+        version = bot.template_version(stage)
+        results[f'render.image.stage{stage}'] = measure(
+            lambda: bot.render_image(html, next(names), version, encoders[0]), args.min_time
+        )
+
+
+def populate_sqlite(path, size):
+    conn = sqlite3.connect(path)
+    SqliteUserStore(path).close()
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO users (telegram_id, name, current_stage) VALUES (?, ?, ?)",
+        ((i, f"user{i}", 1 + i % 3) for i in range(1, size + 1))
+    )
+    conn.execute("COMMIT")
+    conn.close()
+    return SqliteUserStore(path)
+
+
+def populate_csv(path, size):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDS)
+        writer.writerows((f"user{i}", i, 1 + i % 3) for i in range(1, size + 1))
+    return CsvUserStore(path)
+
+
+def populate_cached(path, size):
+    # Запись в базу идет в фоне, замеряется только путь обработчика
+    return CachedUserStore(populate_sqlite(path, size))
+
+
+def bench_store(results, args):
+    """save_user / get_user_stage / update_user_stage на базах разного размера"""
+    backends = [
+        backend for backend in (
+            ('sqlite', populate_sqlite, 'users.db'),
+            ('cached', populate_cached, 'cached.db'),
+            ('csv', populate_csv, 'users.csv'),
+        )
+        if backend[0] in args.backends
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            for name, populate, filename in backends:
+                if name == 'csv' and size > args.csv_max_size:
+                    # CSV переписывается целиком на каждую операцию
+                    continue
+                path = Path(tmp) / f"{size}_{filename}"
+                store = populate(path, size)
+                rng = random.Random(size)
+                new_ids = iter(range(size + 1, size + 10 ** 9))
+                prefix = f'store.{name}.{size}'
+                results[f'{prefix}.get_user_stage'] = measure(
+                    lambda: store.get_user_stage(rng.randint(1, size)), args.min_time
+                )
+                results[f'{prefix}.update_user_stage'] = measure(
+                    lambda: store.update_user_stage(rng.randint(1, size), rng.randint(1, 3)),
+                    args.min_time
+                )
+                results[f'{prefix}.save_user.existing'] = measure(
+                    lambda: store.save_user({
+                        'name': 'user', 'telegram_id': rng.randint(1, size), 'current_stage': 1
+                    }),
+                    args.min_time
+                )
+                results[f'{prefix}.save_user.new'] = measure(
+                    lambda: store.save_user({
+                        'name': 'user', 'telegram_id': next(new_ids), 'current_stage': 1
+                    }),
+                    args.min_time
+                )
+                store.close()
+                path.unlink()
+
+
+class StubBot:
+    """Заглушка Telegram Bot: отвечает мгновенно и выдает file_id"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_photo(self, chat_id, photo, caption=None, reply_markup=None):
+        self.sent += 1
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"file{self.sent}")])
+
+
+class StubMessage:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+
+    async def reply_text(self, text, **kwargs):
+        pass
+
+
+def fake_update(user_id, name, callback_data=None):
+    """Update с полями, которые читают обработчики (callback_data — нажатие кнопки)"""
+    message = StubMessage(user_id)
+    user = SimpleNamespace(id=user_id, first_name=name, username=None)
+    query = None
+    if callback_data is not None:
+        async def answer(*args, **kwargs):
+            pass
+
+        async def edit_message_caption(**kwargs):
+            pass
+
+        query = SimpleNamespace(
+            message=message, data=callback_data, answer=answer, edit_message_caption=edit_message_caption
+        )
+    return SimpleNamespace(
+        effective_user=user, effective_chat=SimpleNamespace(id=user_id),
+        message=message, callback_query=query
+    )
+
+
+async def run_handlers(results, args, tmp):
+    stub = StubBot()
+    context = SimpleNamespace(bot=stub)
+    funnel_bot.bot = FunnelBot(store=SqliteUserStore(Path(tmp) / "e2e.db"))
+    user_ids = iter(range(1, 10 ** 9))
+
+    async def start_cold():
+        # Новое имя: рендер и кодирование на каждом вызове
+        user_id = next(user_ids)
+        await funnel_bot.start_command(fake_update(user_id, f"Имя {user_id}"), context)
+
+    async def start_warm():
+        # Одно имя: изображение уже загружено, отправка по file_id
+        await funnel_bot.start_command(fake_update(next(user_ids), "Анна"), context)
+
+    async def next_stage_warm():
+        user_id = next(user_ids)
+        funnel_bot.bot.save_user({'name': 'Анна', 'telegram_id': user_id, 'current_stage': 1})
+        await funnel_bot.button_handler(fake_update(user_id, "Анна", "next_stage:1"), context)
+
+    async def finish():
+        user_id = next(user_ids)
+        funnel_bot.bot.save_user({
+            'name': 'Анна', 'telegram_id': user_id, 'current_stage': funnel_bot.bot.last_stage
+        })
+        await funnel_bot.button_handler(
+            fake_update(user_id, "Анна", f"next_stage:{funnel_bot.bot.last_stage}"), context
+        )
+
+    with quiet():
+        funnel_bot.render_pool.start()
+        await start_warm()
+        await next_stage_warm()
+        results['e2e.start_command.cold'] = await measure_async(start_cold, args.min_time)
+        results['e2e.start_command.warm'] = await measure_async(start_warm, args.min_time)
+        results['e2e.button_handler.warm'] = await measure_async(next_stage_warm, args.min_time)
+        results['e2e.button_handler.finish'] = await measure_async(finish, args.min_time)
+    funnel_bot.render_pool.shutdown()
+    funnel_bot.bot.store.close()
+
+
+def bench_handlers(results, args):
+    """Полный путь start_command/button_handler с поддельными Update и Bot"""
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run_handlers(results, args, tmp))
+
+
+GROUPS = {
+    'render': bench_render,
+    'store': bench_store,
+    'e2e': bench_handlers,
+}
+
+
+def compare(current, baseline_path):
+    """Печатает изменение медианы относительно прошлого запуска; True, если есть регрессии"""
+    baseline = json.loads(Path(baseline_path).read_text(encoding='utf-8'))['results']
+    regressions = False
+    print(f"\nСравнение с {baseline_path} (p50):", file=sys.stderr)
+    for name, stats in current.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        change = stats['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0.0
+        mark = ' '
+        if change > REGRESSION_THRESHOLD:
+            mark, regressions = '✗', True
+        elif change < -REGRESSION_THRESHOLD:
+            mark = '✓'
+        print(f"{mark} {name:<48} {old['p50_ms']:10.3f} -> {stats['p50_ms']:10.3f} ms ({change:+.1%})", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки воронки")
+    parser.add_argument('--only', default=','.join(GROUPS),
+                        help="группы через запятую: " + ', '.join(GROUPS))
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help="размеры базы пользователей через запятую")
+    parser.add_argument('--backends', default='sqlite,cached,csv', help="хранилища: sqlite, cached, csv")
+    parser.add_argument('--csv-max-size', type=int, default=100000,
+                        help="максимальный размер базы для CSV хранилища")
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help="минимальное время замера одного бенчмарка, секунды")
+    parser.add_argument('--output', help="файл для JSON с результатами")
+    parser.add_argument('--compare', help="JSON прошлого запуска для сравнения")
+    args = parser.parse_args()
+    args.sizes = [int(x) for x in args.sizes.split(',') if x.strip()]
+    args.backends = {x.strip() for x in args.backends.split(',')}
+    # Файлы отчетов — относительно каталога запуска, шаблоны — относительно ROOT
+    args.output = args.output and os.path.abspath(args.output)
+    args.compare = args.compare and os.path.abspath(args.compare)
+    os.chdir(ROOT)
+
+    results = {}
+    for group in args.only.split(','):
+        group = group.strip()
+        if group not in GROUPS:
+            parser.error(f"неизвестная группа: {group}")
+        started = time.perf_counter()
+        GROUPS[group](results, args)
+        print(f"✓ {group}: {time.perf_counter() - started:.1f} с", file=sys.stderr)
+
+    report = {
+        'version': RESULTS_VERSION,
+        **run_info(),
+        'results': results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output, encoding='utf-8')
+    else:
+        print(output)
+    if args.compare and compare(results, args.compare):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
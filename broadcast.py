@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from telegram.error import Forbidden
+
+# Статусы получателей рассылки
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+log = logging.getLogger(__name__)
+
+
+def retry_after_seconds(error):
+    """Секунды ожидания из RetryAfter (int или timedelta в зависимости от версии PTB)"""
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+
+class RateLimiter:
+    """Глобальный лимит отправок в секунду с адаптацией к flood control"""
+
+    def __init__(self, rate, min_rate=1.0, recovery=5.0):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        # За сколько секунд успешных отправок темп восстанавливается вдвое
+        self.recovery = recovery
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._rewarded_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет свободного слота отправки"""
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + 1 / self.rate
+        delay = slot - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def refund(self):
+        """Взятый слот не понадобился: следующий acquire может занять его"""
+        self._next_slot = max(time.monotonic(), self._next_slot - 1 / self.rate)
+
+    def penalize(self, retry_after):
+        """Telegram прислал RetryAfter: ставим паузу и снижаем темп вдвое
+
+        Ответы на запросы, ушедшие до паузы, приходят пачкой — темп за одну
+        паузу снижается один раз.
+        """
+        now = time.monotonic()
+        if self._paused_until <= now:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self._paused_until = max(self._paused_until, now + retry_after)
+
+    def reward(self):
+        """Успешная отправка: постепенно возвращаем темп к максимальному
+
+        Восстановление идет по времени, а не по числу отправок: при сниженном
+        темпе отправок мало, и он возвращался бы к максимуму минутами.
+        """
+        now = time.monotonic()
+        elapsed = min(now - self._rewarded_at, self.recovery)
+        self._rewarded_at = now
+        self.rate = min(self.max_rate, self.rate * 2 ** (elapsed / self.recovery))
+
+
+class PerChatLimiter:
+    """Не чаще одного сообщения в чат за interval секунд"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._last_sent = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        last = self._last_sent.get(chat_id)
+        if last is not None and now - last < self.interval:
+            await asyncio.sleep(self.interval - (now - last))
+        self._last_sent[chat_id] = time.monotonic()
+        # Старые отметки больше не ограничивают отправку
+        if len(self._last_sent) > 10000:
+            cutoff = time.monotonic() - self.interval
+            self._last_sent = {k: v for k, v in self._last_sent.items() if v >= cutoff}
+
+
+class BroadcastCheckpoint:
+    """Прогресс рассылок в SQLite: кампании и статус каждого получателя"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS campaigns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    stage INTEGER NOT NULL,
+                    from_stage INTEGER,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS recipients (
+                    campaign_id INTEGER NOT NULL,
+                    telegram_id INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (campaign_id, telegram_id)
+                )
+            """)
+
+    def create_campaign(self, stage, from_stage=None):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO campaigns (stage, from_stage, created_at) VALUES (?, ?, ?)",
+                (stage, from_stage, time.time())
+            )
+            return cursor.lastrowid
+
+    def unfinished_campaigns(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, stage, from_stage FROM campaigns WHERE status = 'running' ORDER BY id"
+            ).fetchall()
+
+    def finish_campaign(self, campaign_id, status='done'):
+        with self._lock:
+            self._conn.execute("UPDATE campaigns SET status = ? WHERE id = ?", (status, campaign_id))
+
+    def claim(self, campaign_id, telegram_id):
+        """Помечает получателя как «отправляется»; False, если он уже обработан"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO recipients (campaign_id, telegram_id, status, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (campaign_id, int(telegram_id), SENDING, time.time())
+            )
+            return cursor.rowcount == 1
+
+    def release(self, campaign_id, telegram_id):
+        """Снимает отметку с получателя, которому отправка так и не начиналась"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM recipients WHERE campaign_id = ? AND telegram_id = ? AND status = ?",
+                (campaign_id, int(telegram_id), SENDING)
+            )
+
+    def mark(self, campaign_id, telegram_id, status):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE recipients SET status = ?, updated_at = ? WHERE campaign_id = ? AND telegram_id = ?",
+                (status, time.time(), campaign_id, int(telegram_id))
+            )
+
+    def stats(self, campaign_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM recipients WHERE campaign_id = ? GROUP BY status",
+                (campaign_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Broadcaster:
+    """Рассылка этапа всем пользователям хранилища с учетом лимитов Telegram
+
+    Получатель помечается «sending» до отправки. После падения такие записи
+    не отправляются повторно: лучше пропустить одно сообщение, чем продублировать.
+    """
+
+    def __init__(self, store, checkpoint, send, rate=25.0, concurrency=10, per_chat_interval=1.0):
+        self.store = store
+        self.checkpoint = checkpoint
+        # send(telegram_id, stage, user_name) -> корутина отправки
+        self.send = send
+        self.limiter = RateLimiter(rate)
+        self.per_chat = PerChatLimiter(per_chat_interval)
+        self.concurrency = concurrency
+        self._tasks = {}
+
+    def start(self, stage, from_stage=None):
+        """Создает кампанию и запускает ее в фоне, возвращает id кампании"""
+        campaign_id = self.checkpoint.create_campaign(stage, from_stage)
+        self._spawn(campaign_id, stage, from_stage)
+        return campaign_id
+
+    def resume_all(self):
+        """Продолжает кампании, прерванные перезапуском"""
+        resumed = []
+        for campaign_id, stage, from_stage in self.checkpoint.unfinished_campaigns():
+            if campaign_id not in self._tasks:
+                self._spawn(campaign_id, stage, from_stage)
+                resumed.append(campaign_id)
+        return resumed
+
+    def cancel(self, campaign_id):
+        task = self._tasks.get(campaign_id)
+        if task is None:
+            return False
+        task.cancel()
+        self.checkpoint.finish_campaign(campaign_id, 'cancelled')
+        return True
+
+    async def stop(self):
+        """Останавливает кампании без изменения их статуса (продолжатся при запуске)"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, campaign_id, stage, from_stage):
+        task = asyncio.create_task(self.run(campaign_id, stage, from_stage))
+        self._tasks[campaign_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(campaign_id, None))
+
+    async def run(self, campaign_id, stage, from_stage=None):
+        """Выполняет кампанию: поток пользователей -> очередь -> воркеры отправки"""
+        queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        workers = [
+            asyncio.create_task(self._worker(campaign_id, stage, queue))
+            for _ in range(self.concurrency)
+        ]
+        try:
+            for user in self.store.iter_users():
+                if from_stage is not None and user['current_stage'] != from_stage:
+                    continue
+                if not self.checkpoint.claim(campaign_id, user['telegram_id']):
+                    continue
+                await queue.put(user)
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # При остановке получатели из очереди еще не отправлялись — вернем их
+            while not queue.empty():
+                self.checkpoint.release(campaign_id, queue.get_nowait()['telegram_id'])
+        self.checkpoint.finish_campaign(campaign_id)
+        stats = self.checkpoint.stats(campaign_id)
+        log.info("✓ Рассылка %s завершена: %s", campaign_id, stats, extra={'campaign_id': campaign_id})
+        return stats
+
+    async def _worker(self, campaign_id, stage, queue):
+        while True:
+            user = await queue.get()
+            try:
+                await self._deliver(campaign_id, stage, user)
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, campaign_id, stage, user):
+        telegram_id = user['telegram_id']
+        try:
+            await self.limiter.acquire()
+            await self.per_chat.acquire(telegram_id)
+        except asyncio.CancelledError:
+            self.checkpoint.release(campaign_id, telegram_id)
+            raise
+        # Flood control и повторы — в очереди отправки; сюда доходит окончательная ошибка
+        try:
+            await self.send(telegram_id, stage, user['name'])
+        except Forbidden:
+            self.checkpoint.mark(campaign_id, telegram_id, BLOCKED)
+            return
+        except Exception as e:
+            log.error("✗ Рассылка %s: ошибка для %s: %s", campaign_id, telegram_id, e,
+                      extra={'campaign_id': campaign_id, 'user_id': telegram_id})
+            self.checkpoint.mark(campaign_id, telegram_id, FAILED)
+            return
+        self.checkpoint.mark(campaign_id, telegram_id, SENT)
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import Forbidden, RetryAfter
+
+from broadcast import RateLimiter, retry_after_seconds
+
+log = logging.getLogger(__name__)
+
+
+def parse_delays(value):
+    """'3600,86400' -> {1: 3600.0, 2: 86400.0}: задержка после этапа N до этапа N+1"""
+    delays = {}
+    for stage, item in enumerate((value or '').split(','), start=1):
+        item = item.strip()
+        if item and float(item) > 0:
+            delays[stage] = float(item)
+    return delays
+
+
+class TimeWheel:
+    """Хэшированное колесо таймеров: слот на каждые tick секунд
+
+    Добавление и снятие срабатывающих таймеров — O(1) на таймер, без задачи
+    asyncio на каждого пользователя.
+    """
+
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        # номер слота -> {telegram_id: (at, name)}
+        self._slots = {}
+        self._cursor = None
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots.values())
+
+    def add(self, telegram_id, at, name):
+        slot = int(at // self.tick)
+        # Просроченные таймеры попадают в ближайший слот
+        if self._cursor is not None and slot < self._cursor:
+            slot = self._cursor
+        self._slots.setdefault(slot, {})[str(telegram_id)] = (at, name)
+
+    def pop_due(self, now):
+        """Забирает таймеры из всех слотов до текущего момента включительно"""
+        current = int(now // self.tick)
+        due = []
+        for slot in sorted(s for s in self._slots if s <= current):
+            due.extend(
+                (telegram_id, at, name)
+                for telegram_id, (at, name) in self._slots.pop(slot).items()
+            )
+        self._cursor = current + 1
+        return due
+
+    def clear(self):
+        self._slots.clear()
+
+
+class DripScheduler:
+    """Автоматический переход пользователей к следующему этапу по таймеру
+
+    Постоянный индекс таймеров — колонка next_send_at в хранилище пользователей.
+    В колесо в памяти подгружается только ближайшее окно horizon секунд.
+    Перед отправкой таймер атомарно снимается в базе (claim_due), поэтому после
+    перезапуска сообщение не дублируется; таймеры, не успевшие сработать,
+    подгружаются из базы заново.
+    """
+
+    def __init__(self, store, send, delays, last_stage, tick=1.0, horizon=60.0,
+                 batch_size=1000, rate=20.0, concurrency=10):
+        self.store = store
+        # send(telegram_id, stage, user_name) -> корутина отправки
+        self.send = send
+        self.delays = delays
+        # Вызываемый объект: число этапов может меняться при перезагрузке шаблонов
+        self.last_stage = last_stage
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate)
+        self.wheel = TimeWheel(tick)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Позиция чтения индекса: (next_send_at, telegram_id) последнего загруженного таймера
+        self._since = None
+        self._after_id = None
+        self._loaded_until = None
+
+    @classmethod
+    def from_env(cls, store, send, last_stage):
+        """Создает планировщик по переменным DRIP_*; None, если задержки не заданы"""
+        delays = parse_delays(os.getenv("DRIP_DELAYS", ""))
+        if not delays:
+            return None
+        return cls(
+            store, send, delays, last_stage,
+            tick=float(os.getenv("DRIP_TICK", "1")),
+            horizon=float(os.getenv("DRIP_HORIZON", "60")),
+            rate=float(os.getenv("DRIP_RATE", "20")),
+            concurrency=int(os.getenv("DRIP_CONCURRENCY", "10")),
+        )
+
+    def schedule_after(self, telegram_id, stage, user_name):
+        """Пользователь получил этап stage: ставим (или снимаем) таймер следующего"""
+        delay = self.delays.get(stage)
+        at = time.time() + delay if delay and stage < self.last_stage() else None
+        self._set_timer(telegram_id, at, user_name)
+        return at
+
+    def _set_timer(self, telegram_id, at, user_name):
+        self.store.schedule_next(telegram_id, at)
+        # Таймер из уже загруженного окна сразу кладем в колесо
+        if at is not None and self._loaded_until is not None and at < self._loaded_until:
+            self.wheel.add(telegram_id, at, user_name)
+
+    def _load(self, now):
+        """Подгружает из базы таймеры следующего окна"""
+        until = now + self.horizon
+        rows = self.store.due_users(self._since, until, self.batch_size, self._after_id)
+        for row in rows:
+            self.wheel.add(row['telegram_id'], row['next_send_at'], row['name'])
+        if len(rows) < self.batch_size:
+            # Окно прочитано целиком. Следующее чтение снова начнется с now, чтобы
+            # подхватить таймеры, записанные в это окно другими процессами
+            self._since, self._after_id, self._loaded_until = now, None, until
+        else:
+            # Окно не поместилось: дочитаем остаток с этой позиции на следующем шаге
+            last = rows[-1]
+            self._since, self._after_id = last['next_send_at'], last['telegram_id']
+            self._loaded_until = last['next_send_at']
+
+    async def run(self):
+        """Главный цикл: один тик — одна выборка срабатывающих таймеров"""
+        tasks = set()
+        try:
+            while True:
+                now = time.time()
+                # Новое окно читаем заранее, пока колесо не переполнено отставанием
+                if self._loaded_until is None or (
+                    now + self.horizon / 2 >= self._loaded_until and len(self.wheel) < self.batch_size
+                ):
+                    self._load(now)
+                for telegram_id, at, name in self.wheel.pop_due(now):
+                    await self._semaphore.acquire()
+                    task = asyncio.create_task(self._fire(telegram_id, at, name))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await asyncio.sleep(self.wheel.tick)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Несработавшие таймеры остаются в базе и загрузятся при следующем запуске
+            self.wheel.clear()
+            self._since = self._after_id = self._loaded_until = None
+
+    async def _fire(self, telegram_id, at, name):
+        try:
+            await self.limiter.acquire()
+            # Таймер мог быть перенесен нажатием «Далее» — тогда claim не пройдет
+            if not self.store.claim_due(telegram_id, at):
+                return
+            current = self.store.get_user_stage(telegram_id)
+            stage = current + 1
+            if stage > self.last_stage():
+                return
+            # Этап переводится до отправки: одновременное нажатие «Далее» не продублирует его
+            if not self.store.compare_and_set_stage(telegram_id, current, stage):
+                return
+            try:
+                await self.send(telegram_id, stage, name)
+            except RetryAfter as e:
+                # Очередь отправки исчерпала повторы (паузы уже выдержаны ею):
+                # отправка не состоялась — возвращаем этап и переносим таймер
+                retry_after = retry_after_seconds(e)
+                if self.store.compare_and_set_stage(telegram_id, stage, current):
+                    self._set_timer(telegram_id, time.time() + retry_after, name)
+                return
+            except Forbidden:
+                # Пользователь заблокировал бота: таймер уже снят
+                return
+            except Exception as e:
+                log.error("✗ Автоотправка этапа %s для %s: %s", stage, telegram_id, e,
+                          extra={'user_id': telegram_id})
+                self.store.compare_and_set_stage(telegram_id, stage, current)
+                return
+            self.schedule_after(telegram_id, stage, name)
+            log.info("✓ Автоотправка этапа %s для %s", stage, name, extra={'user_id': telegram_id})
+        finally:
+            self._semaphore.release()
@@ -1,413 +1,390 @@
-import csv
+import asyncio
+import functools
+import hashlib
+import io
+import logging
+import multiprocessing
 import os
+import secrets
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from PIL import Image, ImageDraw, ImageFont
 from dotenv import load_dotenv
+from asset_bundle import AssetBundle
+from broadcast import Broadcaster, BroadcastCheckpoint, retry_after_seconds
+from drip import DripScheduler
+from http_server import HttpServer, Response
+from ingress import WORKER_SECRET_HEADER, LocalWorkers, UpdateRouter
+from logs import setup_logging
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY
+from prerender import Prerenderer
+from render_cache import RenderCache
+from send_queue import BULK, INTERACTIVE, SendQueue
+from single_flight import SingleFlight
+from template_compiler import compile_template
+from template_registry import TemplateRegistry
+from update_processor import PerUserUpdateProcessor
+from user_store import create_user_store
 
 # Загружаем переменные окружения
 load_dotenv()
 
+# Увеличьте при изменении кода отрисовки, чтобы сбросить кэш изображений
+RENDER_VERSION = 2
+
+# Сколько скомпилированных шаблонов держать в памяти процесса
+MAX_RENDER_PLANS = 32
+
+# Telegram ID администраторов через запятую (служебные команды)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+# Номер воркера в многопроцессном режиме; фоновые задачи выполняет только воркер 0
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+
+# Типы обновлений, которые получает бот
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+log = logging.getLogger("funnel_bot")
+
+# Метрики для /metrics
+STEP_SECONDS = REGISTRY.histogram(
+    'funnel_step_seconds', 'Длительность шагов отправки этапа', ('step',)
+)
+HANDLER_SECONDS = REGISTRY.histogram(
+    'funnel_handler_seconds', 'Длительность обработчиков обновлений', ('handler',)
+)
+STAGE_SENT = REGISTRY.counter(
+    'funnel_stage_sent_total', 'Отправленные этапы воронки', ('stage', 'source')
+)
+IMAGE_SOURCE = REGISTRY.counter(
+    'funnel_image_source_total', 'Откуда взято изображение этапа', ('source',)
+)
+ERRORS = REGISTRY.counter('funnel_errors_total', 'Ошибки по месту возникновения', ('where',))
+RENDERS_SHARED = REGISTRY.counter(
+    'funnel_renders_shared_total', 'Запросы изображения, дождавшиеся уже идущего рендера'
+)
+SEND_RETRIES = REGISTRY.counter(
+    'funnel_send_retries_total', 'Повторы запросов к Telegram (flood control, сеть)', ('reason',)
+)
+PRERENDERED = REGISTRY.counter(
+    'funnel_prerender_total', 'Предрендер следующего этапа', ('result',)
+)
+
 class FunnelBot:
-    def __init__(self):
+    def __init__(self, store=None):
         self.templates_dir = Path("templates")
-        self.data_file = Path("users_data.csv")
-        
-        # Создаем CSV файл с заголовками если его нет
-        if not self.data_file.exists():
-            with open(self.data_file, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(['name', 'telegram_id', 'current_stage'])
+        # Все шаблоны читаются при старте и отдаются из памяти
+        self.templates = TemplateRegistry(self.templates_dir)
+        # Скомпилированные шаблоны: ключ версии -> RenderPlan
+        self._plans = {}
+        # Хранилище открывается лениво: воркерам рендеринга оно не нужно
+        self._store = store
+        # Пакет ресурсов (ASSET_BUNDLE) открывается при первом рендере в процессе
+        self._assets = None
+        self._assets_loaded = False
+    
+    @property
+    def store(self):
+        """Хранилище пользователей (UserStore)"""
+        if self._store is None:
+            # Воркеры многопроцессного режима меняют этапы одних и тех же пользователей
+            # (автоотправка и рассылки идут с воркера 0): отложенная запись там небезопасна
+            self._store = create_user_store(cache=os.getenv("BOT_MODE", "polling").lower() != "worker")
+        return self._store
+    
+    @property
+    def assets(self):
+        """Пакет ресурсов (AssetBundle) или None, если он не собран"""
+        if not self._assets_loaded:
+            self._assets = AssetBundle.from_env(RENDER_VERSION)
+            self._assets_loaded = True
+        return self._assets
     
     def load_template(self, stage):
-        """Загружает HTML шаблон для этапа"""
-        files = list(self.templates_dir.glob(f"stage{stage}_*.html"))
-        if not files:
-            raise FileNotFoundError(f"Template for stage {stage} not found")
-        
-        with open(files[0], 'r', encoding='utf-8') as f:
-            return f.read()
+        """Возвращает HTML шаблон для этапа из памяти"""
+        return self.templates.get(stage)
+    
+    def template_version(self, stage):
+        """Версия шаблона для ключей кэша (меняется вместе с шаблоном или RENDER_VERSION)"""
+        return f"{RENDER_VERSION}:{self.templates.stage_version(stage)}"
     
-    def personalize_template(self, template_html, user_name):
-        """Подставляет только имя пользователя в шаблон"""
-        return template_html.replace("{{name}}", user_name)
+    @property
+    def last_stage(self):
+        """Номер последнего этапа воронки (по найденным шаблонам)"""
+        return max(self.templates.stages, default=1)
     
-    def html_to_png(self, html_content, output_path, user_name):
-        """Конвертирует HTML в PNG с персонализацией"""
+    def get_render_plan(self, template_html, plan_key=None):
+        """Компилирует шаблон в план отрисовки один раз для каждой версии
+
+        Шаблон, собранный в пакет ресурсов, берется из пакета без компиляции.
+        """
+        if plan_key is None:
+            plan_key = hashlib.sha256(template_html.encode('utf-8')).hexdigest()
+        plan = self._plans.get(plan_key)
+        if plan is None:
+            assets = self.assets
+            plan = assets.plan(template_html) if assets is not None else None
+            if plan is None:
+                plan = compile_template(template_html)
+            self._plans[plan_key] = plan
+            # Старые версии шаблонов вытесняем в порядке добавления
+            while len(self._plans) > MAX_RENDER_PLANS:
+                self._plans.pop(next(iter(self._plans)))
+        return plan
+    
+    def render_image(self, html_content, user_name, plan_key=None, encoder=None, timings=None):
+        """Рисует изображение по шаблону и кодирует его в память
+
+        В timings (если передан) записываются длительности шагов render и encode.
+        """
         try:
-            # Заменяем плейсхолдеры на реальные данные
-            html_content = html_content.replace("{{name}}", user_name)
-            
-            # Создаем изображение 1080x1080
-            img = Image.new('RGB', (1080, 1080), color='white')
-            draw = ImageDraw.Draw(img)
-            
-            # Определяем этап по пути файла
-            stage = 1
-            if 'stage2' in str(output_path):
-                stage = 2
-            elif 'stage3' in str(output_path):
-                stage = 3
-            
-            # Цветовые схемы для каждого этапа
-            if stage == 1:
-                # Этап 1: Привлечение внимания (красно-оранжевый)
-                bg_colors = ['#ff6b6b', '#ee5a24', '#ff9ff3']
-                text_color = '#ffffff'
-                accent_color = '#ffd700'
-            elif stage == 2:
-                # Этап 2: Решение (сине-фиолетовый)
-                bg_colors = ['#667eea', '#764ba2', '#f093fb']
-                text_color = '#ffffff'
-                accent_color = '#00d2d3'
-            else:  # stage 3
-                # Этап 3: Срочность (красный)
-                bg_colors = ['#ff0844', '#ffb199', '#ff6b6b']
-                text_color = '#ffffff'
-                accent_color = '#fff200'
-            
-            # Рисуем градиентный фон
-            self._draw_advanced_gradient(draw, 1080, 1080, bg_colors)
-            
-            # Настройки шрифта
-            try:
-                # Пытаемся загрузить шрифты
-                font_emoji = ImageFont.truetype("arial.ttf", 120)
-                font_title = ImageFont.truetype("arial.ttf", 72)
-                font_subtitle = ImageFont.truetype("arial.ttf", 56)
-                font_text = ImageFont.truetype("arial.ttf", 42)
-                font_small = ImageFont.truetype("arial.ttf", 32)
-            except:
-                # Если шрифты не найдены, используем дефолтные
-                font_emoji = ImageFont.load_default()
-                font_title = ImageFont.load_default()
-                font_subtitle = ImageFont.load_default()
-                font_text = ImageFont.load_default()
-                font_small = ImageFont.load_default()
-            
-            # Рисуем персонализированный контент
-            if stage == 1:
-                self._draw_stage1_content(draw, user_name, stage, font_emoji, font_title, font_subtitle, font_text, font_small)
-            elif stage == 2:
-                self._draw_stage2_content(draw, user_name, stage, font_emoji, font_title, font_subtitle, font_text, font_small)
-            else:  # stage 3
-                self._draw_stage3_content(draw, user_name, stage, font_emoji, font_title, font_subtitle, font_text, font_small)
-            
-            # Сохраняем изображение
-            output_path.parent.mkdir(exist_ok=True)
-            img.save(output_path, 'PNG')
-            print(f"✓ Изображение создано: {output_path}")
-            return output_path
-            
-        except Exception as e:
-            print(f"Error converting HTML to PNG: {e}")
+            started = time.perf_counter()
+            img = self.get_render_plan(html_content, plan_key).render(user_name)
+            rendered = time.perf_counter()
+            image = (encoder or ImageEncoder()).encode(img)
+            if timings is not None:
+                timings['render'] = rendered - started
+                timings['encode'] = time.perf_counter() - rendered
+            return image
+        except Exception:
+            log.exception("✗ Ошибка отрисовки изображения")
             return None
     
-    def _draw_gradient_background(self, draw, width, height):
-        """Рисует градиентный фон"""
-        for y in range(height):
-            r = int(102 + (118 - 102) * y / height)
-            g = int(126 + (75 - 126) * y / height)
-            b = int(234 + (162 - 234) * y / height)
-            draw.line([(0, y), (width, y)], fill=(r, g, b))
-    
-    def _draw_advanced_gradient(self, draw, width, height, colors):
-        """Рисует улучшенный градиентный фон"""
-        for y in range(height):
-            # Интерполяция между цветами
-            ratio = y / height
-            if len(colors) == 3:
-                # Трехцветный градиент
-                if ratio < 0.5:
-                    # Переход от первого ко второму цвету
-                    local_ratio = ratio * 2
-                    color1 = self._hex_to_rgb(colors[0])
-                    color2 = self._hex_to_rgb(colors[1])
-                else:
-                    # Переход от второго к третьему цвету
-                    local_ratio = (ratio - 0.5) * 2
-                    color1 = self._hex_to_rgb(colors[1])
-                    color2 = self._hex_to_rgb(colors[2])
-                
-                r = int(color1[0] + (color2[0] - color1[0]) * local_ratio)
-                g = int(color1[1] + (color2[1] - color1[1]) * local_ratio)
-                b = int(color1[2] + (color2[2] - color1[2]) * local_ratio)
-            else:
-                # Двухцветный градиент
-                color1 = self._hex_to_rgb(colors[0])
-                color2 = self._hex_to_rgb(colors[1])
-                r = int(color1[0] + (color2[0] - color1[0]) * ratio)
-                g = int(color1[1] + (color2[1] - color1[1]) * ratio)
-                b = int(color1[2] + (color2[2] - color1[2]) * ratio)
-            
-            draw.line([(0, y), (width, y)], fill=(r, g, b))
-    
-    def _hex_to_rgb(self, hex_color):
-        """Конвертирует hex цвет в RGB"""
-        hex_color = hex_color.lstrip('#')
-        return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-    
-    def _draw_stage1_content(self, draw, user_name, stage, font_emoji, font_title, font_subtitle, font_text, font_small):
-        """Рисует контент для этапа 1: Привлечение внимания"""
-        # Эмодзи
-        emoji = "⚡"
-        
-        # Рисуем эмодзи
-        bbox = draw.textbbox((0, 0), emoji, font=font_emoji)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 100), emoji, font=font_emoji, fill='#ffffff')
-        
-        # Заголовок
-        title = "ТЫ ПРОПУСТИЛ\nВАЖНОЕ!"
-        
-        lines = title.split('\n')
-        y_offset = 250
-        for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=font_title)
-            text_width = bbox[2] - bbox[0]
-            x = (1080 - text_width) // 2
-            draw.text((x, y_offset), line, font=font_title, fill='#ffffff')
-            y_offset += 80
-        
-        # Имя пользователя
-        name_text = f"Привет, {user_name}!"
-        
-        bbox = draw.textbbox((0, 0), name_text, font=font_subtitle)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 450), name_text, font=font_subtitle, fill='#ffd700')
-        
-        # Основной текст
-        main_text = [
-            "Каждый день упускаются",
-            "ОГРОМНЫЕ ВОЗМОЖНОСТИ",
-            "из-за неавтоматизированных процессов"
-        ]
-        
-        y_offset = 550
-        for line in main_text:
-            bbox = draw.textbbox((0, 0), line, font=font_text)
-            text_width = bbox[2] - bbox[0]
-            x = (1080 - text_width) // 2
-            draw.text((x, y_offset), line, font=font_text, fill='#ffffff')
-            y_offset += 50
-        
-        # Финальный призыв
-        final_text = "🔥 НО ЭТО МОЖНО ИСПРАВИТЬ ПРЯМО СЕЙЧАС! 🔥"
-        
-        bbox = draw.textbbox((0, 0), final_text, font=font_text)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 750), final_text, font=font_text, fill='#ffd700')
-    
-    def _draw_stage2_content(self, draw, user_name, stage, font_emoji, font_title, font_subtitle, font_text, font_small):
-        """Рисует контент для этапа 2: Решение"""
-        # Эмодзи
-        emoji = "💡"
-        
-        bbox = draw.textbbox((0, 0), emoji, font=font_emoji)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 100), emoji, font=font_emoji, fill='#ffffff')
-        
-        # Заголовок
-        title = "ЕСТЬ РЕШЕНИЕ!"
-        
-        bbox = draw.textbbox((0, 0), title, font=font_title)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 250), title, font=font_title, fill='#ffffff')
-        
-        # Имя пользователя
-        name_text = f"{user_name}, мы знаем как помочь"
-        
-        bbox = draw.textbbox((0, 0), name_text, font=font_subtitle)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 350), name_text, font=font_subtitle, fill='#00d2d3')
-        
-        # Преимущества
-        benefits = [
-            "📈 +40% ЭФФЕКТИВНОСТИ",
-            "⏱️ -10 ЧАСОВ/НЕДЕЛЮ",
-            "💰 ROI ЗА 30 ДНЕЙ"
-        ]
-        
-        y_offset = 450
-        for benefit in benefits:
-            bbox = draw.textbbox((0, 0), benefit, font=font_text)
-            text_width = bbox[2] - bbox[0]
-            x = (1080 - text_width) // 2
-            draw.text((x, y_offset), benefit, font=font_text, fill='#ffeb3b')
-            y_offset += 60
-        
-        # Описание
-        description = "Наша платформа позволит экономить\n10+ ЧАСОВ В НЕДЕЛЮ\nна рутинных задачах"
-        
-        lines = description.split('\n')
-        y_offset = 650
-        for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=font_small)
-            text_width = bbox[2] - bbox[0]
-            x = (1080 - text_width) // 2
-            draw.text((x, y_offset), line, font=font_small, fill='#ffffff')
-            y_offset += 45
-        
-        # Финальный призыв
-        final_text = "🎯 СПЕЦИАЛЬНО ДЛЯ ПРОФЕССИОНАЛОВ 🎯"
-        
-        bbox = draw.textbbox((0, 0), final_text, font=font_small)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 800), final_text, font=font_small, fill='#00d2d3')
-    
-    def _draw_stage3_content(self, draw, user_name, stage, font_emoji, font_title, font_subtitle, font_text, font_small):
-        """Рисует контент для этапа 3: Срочность"""
-        # Эмодзи
-        emoji = "🚨"
-        
-        bbox = draw.textbbox((0, 0), emoji, font=font_emoji)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 100), emoji, font=font_emoji, fill='#ffffff')
-        
-        # Заголовок
-        title = "ПОСЛЕДНИЙ\nШАНС!"
-        
-        lines = title.split('\n')
-        y_offset = 250
-        for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=font_title)
-            text_width = bbox[2] - bbox[0]
-            x = (1080 - text_width) // 2
-            draw.text((x, y_offset), line, font=font_title, fill='#ffffff')
-            y_offset += 85
-        
-        # Имя пользователя
-        name_text = f"{user_name}, время почти вышло!"
-        
-        bbox = draw.textbbox((0, 0), name_text, font=font_subtitle)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 450), name_text, font=font_subtitle, fill='#fff200')
-        
-        # Срочность
-        urgent_text = "⏰ ОСТАЛОСЬ ВСЕГО 24 ЧАСА! ⏰"
-        
-        bbox = draw.textbbox((0, 0), urgent_text, font=font_text)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 520), urgent_text, font=font_text, fill='#fff200')
-        
-        # Предложение
-        offer_lines = [
-            "🎁 СПЕЦИАЛЬНАЯ ЦЕНА: -50%",
-            "ДО ПОЛУНОЧИ!"
-        ]
-        
-        y_offset = 600
-        for line in offer_lines:
-            bbox = draw.textbbox((0, 0), line, font=font_text)
-            text_width = bbox[2] - bbox[0]
-            x = (1080 - text_width) // 2
-            draw.text((x, y_offset), line, font=font_text, fill='#ffffff')
-            y_offset += 50
-        
-        # Количество мест
-        spots_text = "🔥 СВОБОДНЫХ МЕСТ: 3 ИЗ 10 🔥"
-        
-        bbox = draw.textbbox((0, 0), spots_text, font=font_small)
-        text_width = bbox[2] - bbox[0]
-        x = (1080 - text_width) // 2
-        draw.text((x, 720), spots_text, font=font_small, fill='#fff200')
-        
-        # Финальный призыв
-        final_text = "Не упусти шанс присоединиться к\nУСПЕШНЫМ ПРЕДПРИНИМАТЕЛЯМ!"
-        
-        lines = final_text.split('\n')
-        y_offset = 800
-        for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=font_small)
-            text_width = bbox[2] - bbox[0]
-            x = (1080 - text_width) // 2
-            draw.text((x, y_offset), line, font=font_small, fill='#fff200')
-            y_offset += 50
-    
     def save_user(self, user_data):
-        """Сохраняет данные пользователя в CSV"""
+        """Сохраняет данные пользователя в хранилище"""
         try:
-            # Проверяем, есть ли уже пользователь
-            users = []
-            user_exists = False
-            
-            try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
-                    for row in reader:
-                        users.append(row)
-                        if row['telegram_id'] == user_data['telegram_id']:
-                            user_exists = True
-                            # Обновляем данные
-                            row['name'] = user_data['name']
-                            row['current_stage'] = user_data.get('current_stage', 1)
-            except:
-                pass
-            
-            # Если пользователь новый, добавляем его
-            if not user_exists:
-                users.append({
-                    'name': user_data['name'],
-                    'telegram_id': user_data['telegram_id'],
-                    'current_stage': user_data.get('current_stage', 1)
-                })
-            
-            # Записываем обратно в CSV
-            with open(self.data_file, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=['name', 'telegram_id', 'current_stage'])
-                writer.writeheader()
-                writer.writerows(users)
-            
-            print(f"✓ Данные пользователя {user_data['name']} сохранены")
+            with STEP_SECONDS.time(step='store_write'):
+                self.store.save_user(user_data)
+            log.debug("✓ Данные пользователя %s сохранены", user_data['name'])
             return True
         except Exception as e:
-            print(f"✗ Ошибка сохранения данных: {e}")
+            ERRORS.inc(where='store')
+            log.error("✗ Ошибка сохранения данных: %s", e, extra={'user_id': user_data['telegram_id']})
             return False
     
     def get_user_stage(self, telegram_id):
         """Получает текущий этап пользователя"""
         try:
-            with open(self.data_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row['telegram_id'] == str(telegram_id):
-                        return int(row.get('current_stage', 1))
-        except:
-            pass
+            with STEP_SECONDS.time(step='store_read'):
+                return self.store.get_user_stage(telegram_id)
+        except Exception as e:
+            ERRORS.inc(where='store')
+            log.error("✗ Ошибка чтения этапа: %s", e, extra={'user_id': telegram_id})
         return 1
     
     def update_user_stage(self, telegram_id, stage):
         """Обновляет этап пользователя"""
         try:
-            users = []
-            with open(self.data_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row['telegram_id'] == str(telegram_id):
-                        row['current_stage'] = stage
-                    users.append(row)
-            
-            with open(self.data_file, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=['name', 'telegram_id', 'current_stage'])
-                writer.writeheader()
-                writer.writerows(users)
+            with STEP_SECONDS.time(step='store_write'):
+                self.store.update_user_stage(telegram_id, stage)
+        except Exception as e:
+            ERRORS.inc(where='store')
+            log.error("✗ Ошибка обновления этапа: %s", e, extra={'user_id': telegram_id})
+    
+    def advance_user_stage(self, telegram_id, expected_stage, stage, user_name=None):
+        """Переводит пользователя на этап stage, только если он все еще на expected_stage"""
+        try:
+            with STEP_SECONDS.time(step='store_write'):
+                return self.store.compare_and_set_stage(telegram_id, expected_stage, stage, user_name)
         except Exception as e:
-            print(f"✗ Ошибка обновления этапа: {e}")
+            ERRORS.inc(where='store')
+            log.error("✗ Ошибка перехода этапа: %s", e, extra={'user_id': telegram_id})
+            return False
+
+    def funnel_stats(self, days=7):
+        """Входы в этапы за все время и за последние days дней (UTC) из счетчиков хранилища"""
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (days - 1) * 86400))
+        return self.store.stage_entries(), self.store.daily_stage_entries(since)
+
+def format_funnel_stats(totals, daily, last_stage):
+    """Текст отчета: входы в этапы, конверсия и отток между этапами, завершения"""
+    lines = ["📊 Воронка за все время:"]
+    previous = None
+    for stage in range(1, last_stage + 1):
+        count = totals.get(stage, 0)
+        line = f"Этап {stage}: {count}"
+        if previous:
+            line += f" ({count * 100 // previous}% от этапа {stage - 1}, ушли {max(previous - count, 0)})"
+        lines.append(line)
+        previous = count
+    lines.append(f"Завершили воронку: {totals.get(last_stage, 0)}")
+    if daily:
+        lines.append("")
+        lines.append("По дням (этапы 1 → " + str(last_stage) + "):")
+        for day, entries in sorted(daily.items(), reverse=True):
+            lines.append(f"{day}: " + " → ".join(str(entries.get(stage, 0)) for stage in range(1, last_stage + 1)))
+    return "\n".join(lines)
+
+class ImageEncoder:
+    """Кодирование изображения в память в выбранном формате"""
+    
+    # Расширения файлов для поддерживаемых форматов
+    EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+    
+    def __init__(self, image_format='JPEG', quality=90, effort=None):
+        image_format = image_format.upper()
+        if image_format == 'JPG':
+            image_format = 'JPEG'
+        if image_format not in self.EXTENSIONS:
+            raise ValueError(f"Unknown image format: {image_format}")
+        self.format = image_format
+        self.quality = quality
+        # Усилие сжатия: PNG compress_level 0-9, WebP method 0-6, JPEG optimize при >= 6
+        self.effort = effort
+    
+    @classmethod
+    def from_env(cls):
+        """Создает кодировщик по переменным окружения IMAGE_*"""
+        effort = os.getenv("IMAGE_EFFORT")
+        return cls(
+            image_format=os.getenv("IMAGE_FORMAT", "JPEG"),
+            quality=int(os.getenv("IMAGE_QUALITY", "90")),
+            effort=int(effort) if effort else None,
+        )
+    
+    @property
+    def extension(self):
+        return self.EXTENSIONS[self.format]
+    
+    @property
+    def signature(self):
+        """Строка настроек для ключей кэша"""
+        return f"{self.format}:{self.quality}:{self.effort}"
+    
+    def encode(self, img):
+        """Кодирует изображение в байты"""
+        params = {}
+        if self.format == 'PNG':
+            if self.effort is not None:
+                params['compress_level'] = min(max(self.effort, 0), 9)
+        elif self.format == 'JPEG':
+            params['quality'] = self.quality
+            if self.effort is not None and self.effort >= 6:
+                params['optimize'] = True
+        else:
+            params['quality'] = self.quality
+            if self.effort is not None:
+                params['method'] = min(max(self.effort, 0), 6)
+        buffer = io.BytesIO()
+        img.save(buffer, self.format, **params)
+        return buffer.getvalue()
+
+class RenderPool:
+    """Пул воркеров для рендеринга изображений вне event loop"""
+    
+    def __init__(self, kind='process', workers=None, max_pending=None, initializer=None):
+        if kind not in ('process', 'thread'):
+            raise ValueError(f"Unknown render executor: {kind}")
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        # Сколько задач может одновременно находиться в пуле
+        self.max_pending = max_pending or self.workers * 4
+        # Выполняется в каждом воркере при запуске (прогрев)
+        self.initializer = initializer
+        self._executor = None
+        self._slots = asyncio.Semaphore(self.max_pending)
+    
+    @classmethod
+    def from_env(cls, initializer=None):
+        """Создает пул по переменным окружения RENDER_*"""
+        workers = os.getenv("RENDER_WORKERS")
+        max_pending = os.getenv("RENDER_QUEUE_SIZE")
+        return cls(
+            kind=os.getenv("RENDER_EXECUTOR", "process"),
+            workers=int(workers) if workers else None,
+            max_pending=int(max_pending) if max_pending else None,
+            initializer=initializer,
+        )
+    
+    def start(self):
+        """Запускает воркеры (вызывается один раз при старте бота)"""
+        if self._executor is not None:
+            return
+        if self.kind == 'process':
+            # spawn не наследует потоки и сокеты event loop родителя
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=self.initializer
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix='render',
+                initializer=self.initializer
+            )
+        log.info("✓ Пул рендеринга запущен: %s x%s", self.kind, self.workers)
+    
+    async def warm_up(self):
+        """Запускает все воркеры сразу, а не при первых рендерах
+
+        Воркеры создаются по требованию: workers одновременных задач поднимают
+        их все, и каждый выполняет initializer до приема задач.
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, time.sleep, 0) for _ in range(self.workers)
+        ))
+        log.info("✓ Воркеры рендеринга прогреты за %.2f с", time.perf_counter() - started)
+    
+    async def run(self, func, *args):
+        """Выполняет func(*args) в пуле, ожидая свободного места в очереди"""
+        self.start()
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+    
+    def shutdown(self):
+        """Останавливает воркеры"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+def render_stage_image(html_content, user_name, plan_key, encoder):
+    """Рендерит и кодирует изображение этапа (выполняется в воркере пула)
+
+    Возвращает (изображение, длительности шагов): метрики живут в основном процессе.
+    """
+    timings = {}
+    image = bot.render_image(html_content, user_name, plan_key, encoder, timings)
+    return image, timings
+
+def warm_render_worker():
+    """Прогрев воркера рендеринга: план и шрифты каждого этапа до первого пользователя"""
+    for stage in bot.templates.stages:
+        bot.render_image(bot.load_template(stage), "Гость", bot.template_version(stage), image_encoder)
 
 # Инициализируем бота
 bot = FunnelBot()
+render_pool = RenderPool.from_env(warm_render_worker)
+render_cache = RenderCache.from_env()
+# Рендеры, выполняющиеся сейчас, по ключу кэша
+render_flights = SingleFlight()
+image_encoder = ImageEncoder.from_env()
+send_queue = SendQueue.from_env(on_retry=lambda reason, delay: SEND_RETRIES.inc(reason=reason))
+background_tasks = []
+broadcaster = None
+drip = None
+prerenderer = None
+metrics_server = None
+
+def timed_handler(name):
+    """Замеряет длительность обработчика в funnel_handler_seconds"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update, context):
+            with HANDLER_SECONDS.time(handler=name):
+                return await func(update, context)
+        return wrapper
+    return decorator
 
+@timed_handler('start')
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
@@ -424,129 +401,601 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Отправляем первый этап
     await send_stage(update, context, 1, user_data['name'])
     
-    print(f"✓ Новый пользователь: {user_data['name']} (ID: {user_data['telegram_id']})")
+    log.info("✓ Новый пользователь: %s", user_data['name'], extra={'user_id': user_data['telegram_id']})
 
+@timed_handler('next')
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатия на кнопку 'Далее'"""
     query = update.callback_query
-    await query.answer()
+    try:
+        await query.answer()
+    except TelegramError as e:
+        # «Часики» на кнопке пропадут сами, отправка этапа важнее
+        log.debug("Не удалось ответить на нажатие: %s", e)
     
     user = update.effective_user
     user_name = user.first_name or user.username or 'Уважаемый клиент'
     
-    # Получаем текущий этап
-    current_stage = bot.get_user_stage(user.id)
+    # Этап, к которому относится нажатая кнопка (у старых кнопок его нет — берем из базы)
+    _, _, button_stage = (query.data or '').partition(':')
+    current_stage = int(button_stage) if button_stage.isdigit() else bot.get_user_stage(user.id)
     
     # Переходим к следующему этапу
     next_stage = current_stage + 1
     
-    if next_stage <= 3:
-        # Обновляем этап в CSV
-        bot.update_user_stage(user.id, next_stage)
-        
-        # Отправляем следующий этап
-        await send_stage(update, context, next_stage, user_name)
+    if next_stage <= bot.last_stage:
+        # Переход атомарный: повторное нажатие той же кнопки или параллельное
+        # обновление не отправят этап дважды и не перепрыгнут через него
+        if not bot.advance_user_stage(user.id, current_stage, next_stage, user_name):
+            return
+        
+        # Отправляем следующий этап; если не вышло, возвращаем текущий, чтобы кнопка сработала снова
+        if not await send_stage(update, context, next_stage, user_name):
+            bot.advance_user_stage(user.id, next_stage, current_stage)
     else:
         # Воронка завершена
-        await query.edit_message_caption(
+        await send_queue.send(query.message.chat_id, functools.partial(
+            query.edit_message_caption,
             caption="✅ Воронка завершена! Спасибо за внимание.",
             reply_markup=None
+        ))
+
+def stage_cache_key(stage, user_name):
+    """Ключ кэша изображения этапа для имени (с версией шаблона и настройками кодирования)"""
+    return render_cache.make_key(stage, user_name, f"{bot.template_version(stage)}:{image_encoder.signature}")
+
+async def render_stage(stage, user_name, cache_key):
+    """Рендерит этап в пуле и сохраняет изображение в кэш
+
+    Одновременные запросы одного изображения (этап, имя, версия шаблона)
+    ждут один рендер: двойные нажатия, пользователи с одинаковыми именами,
+    предрендер вместе с нажатием «Далее».
+    """
+    if render_flights.in_flight(cache_key):
+        RENDERS_SHARED.inc()
+    return await render_flights.run(cache_key, _render_stage, stage, user_name, cache_key)
+
+async def _render_stage(stage, user_name, cache_key):
+    # Шаблон компилируется в воркере один раз, имя подставляется при отрисовке
+    with STEP_SECONDS.time(step='render_pool'):
+        image, timings = await render_pool.run(
+            render_stage_image, bot.load_template(stage), user_name, bot.template_version(stage), image_encoder
         )
+    for step, seconds in timings.items():
+        STEP_SECONDS.observe(seconds, step=step)
+    if image is None:
+        raise RuntimeError(f"Не удалось отрисовать этап {stage}")
+    render_cache.put(cache_key, image, image_encoder.extension)
+    return image
+
+async def prerender_stage(stage, user_name):
+    """Готовит изображение этапа заранее; (ключ, размер) или None, если готовить нечего"""
+    if stage > bot.last_stage:
+        return None
+    cache_key = stage_cache_key(stage, user_name)
+    # Уже загружено в Telegram или лежит в кэше — отправка обойдется без рендера
+    if render_cache.get_file_id(cache_key) is not None or render_cache.contains(cache_key):
+        PRERENDERED.inc(result='cached')
+        return None
+    image = await render_stage(stage, user_name, cache_key)
+    PRERENDERED.inc(result='rendered')
+    return cache_key, len(image)
+
+async def deliver_stage(tg_bot, chat_id, stage, user_name, source='bot'):
+    """Отправляет изображение этапа в чат, по возможности без рендера и загрузки
+
+    source — откуда пришла отправка (start, button, broadcast, drip) для метрик;
+    рассылка и автоотправка уступают очередь ответам на действия пользователя.
+    """
+    cache_key = stage_cache_key(stage, user_name)
+    priority = BULK if source in ('broadcast', 'drip') else INTERACTIVE
+    caption = f"Этап {stage}/{bot.last_stage}"
+    
+    # Создаем кнопку "Далее" (только если это не последний этап)
+    keyboard = None
+    if stage < bot.last_stage:
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("Далее ➡️", callback_data=f"next_stage:{stage}")
+        ]])
+    
+    # Если такое изображение уже загружалось, отправляем по file_id
+    sent = None
+    file_id = render_cache.get_file_id(cache_key)
+    if file_id is not None:
+        try:
+            with STEP_SECONDS.time(step='send_file_id'):
+                sent = await send_queue.send(chat_id, functools.partial(
+                    tg_bot.send_photo, chat_id=chat_id, photo=file_id, caption=caption, reply_markup=keyboard
+                ), priority)
+            IMAGE_SOURCE.inc(source='file_id')
+        except BadRequest:
+            render_cache.forget_file_id(cache_key)
+    
+    if sent is None:
+        image = render_cache.get(cache_key, image_encoder.extension)
+        if image is None:
+            image = await render_stage(stage, user_name, cache_key)
+            IMAGE_SOURCE.inc(source='render')
+        else:
+            IMAGE_SOURCE.inc(source='cache')
+        
+        # Отправляем фото из памяти и запоминаем file_id для повторных отправок
+        with STEP_SECONDS.time(step='send_upload'):
+            sent = await send_queue.send(chat_id, functools.partial(
+                tg_bot.send_photo, chat_id=chat_id, photo=image, caption=caption, reply_markup=keyboard
+            ), priority)
+        if sent.photo:
+            render_cache.set_file_id(cache_key, sent.photo[-1].file_id)
+    
+    STAGE_SENT.inc(stage=stage, source=source)
+    return sent
 
 async def send_stage(update: Update, context: ContextTypes.DEFAULT_TYPE, stage: int, user_name: str):
-    """Отправляет этап воронки"""
+    """Отправляет этап воронки; False, если отправить не удалось
+
+    Flood control и сетевые сбои переживает очередь отправки. Ошибка, с
+    которой она не справилась, только логируется: пользователю текст ошибки
+    не нужен, а отправить его, скорее всего, тоже не получится.
+    """
+    # Если вызвано из кнопки, отвечаем в чат сообщения с кнопкой, иначе в чат /start
+    message = update.callback_query.message if update.callback_query else update.message
+    source = 'button' if update.callback_query else 'start'
     try:
-        # Загружаем шаблон
-        template_html = bot.load_template(stage)
-        
-        # Персонализируем (только имя)
-        personalized_html = template_html.replace('{{name}}', user_name)
-        
-        # Конвертируем в PNG
-        safe_name = user_name.replace(' ', '_')
-        png_path = Path(f"temp/stage{stage}_{safe_name}.png")
-        png_path.parent.mkdir(exist_ok=True)
-        bot.html_to_png(personalized_html, png_path, user_name)
-        
-        # Создаем кнопку "Далее" (только если это не последний этап)
-        keyboard = None
-        if stage < 3:
-            keyboard = InlineKeyboardMarkup([[
-                InlineKeyboardButton("Далее ➡️", callback_data="next_stage")
-            ]])
-        
-        # Отправляем фото
-        with open(png_path, 'rb') as photo:
-            if update.callback_query:
-                # Если вызвано из кнопки, редактируем сообщение
-                await update.callback_query.message.reply_photo(
-                    photo=photo,
-                    caption=f"Этап {stage}/3",
-                    reply_markup=keyboard
-                )
+        await deliver_stage(context.bot, message.chat_id, stage, user_name, source)
+        log.info("✓ Отправлен этап %s для %s", stage, user_name, extra={'user_id': update.effective_user.id})
+        # Если пользователь замолчит, следующий этап придет по таймеру
+        if drip is not None:
+            drip.schedule_after(update.effective_user.id, stage, user_name)
+        # Пока пользователь читает этап, готовим следующий: «Далее» только отправит его
+        if prerenderer is not None:
+            if stage < bot.last_stage:
+                if not prerenderer.schedule(update.effective_user.id, stage + 1, user_name):
+                    PRERENDERED.inc(result='dropped')
             else:
-                # Если вызвано из команды /start
-                await update.message.reply_photo(
-                    photo=photo,
-                    caption=f"Этап {stage}/3",
-                    reply_markup=keyboard
-                )
-        
-        print(f"✓ Отправлен этап {stage} для {user_name}")
+                prerenderer.cancel(update.effective_user.id)
+        return True
         
     except Exception as e:
-        print(f"✗ Ошибка отправки этапа {stage} для {user_name}: {e}")
-        if update.callback_query:
-            await update.callback_query.message.reply_text(f"Ошибка: {e}")
-        else:
-            await update.message.reply_text(f"Ошибка: {e}")
+        ERRORS.inc(where='send')
+        log.error("✗ Ошибка отправки этапа %s для %s: %s", stage, user_name, e,
+                  extra={'user_id': update.effective_user.id})
+        if prerenderer is not None:
+            prerenderer.cancel(update.effective_user.id)
+        return False
+
+async def reply_text(message, text):
+    """Текстовый ответ через очередь отправки"""
+    return await send_queue.send(message.chat_id, functools.partial(message.reply_text, text))
+
+def is_admin(user):
+    """Проверяет, входит ли пользователь в ADMIN_IDS"""
+    return user is not None and user.id in ADMIN_IDS
+
+async def reload_templates_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /reload_templates (только для админов)"""
+    if not is_admin(update.effective_user):
+        return
+    stages = bot.templates.reload()
+    await reply_text(update.message, f"✅ Шаблоны перезагружены: этапы {stages}, версия {bot.templates.version}")
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /broadcast <этап> [только_с_этапа] (только для админов)"""
+    if not is_admin(update.effective_user):
+        return
+    try:
+        stage = int(context.args[0])
+        from_stage = int(context.args[1]) if len(context.args) > 1 else None
+    except (IndexError, ValueError):
+        await reply_text(update.message, "Использование: /broadcast <этап> [только_с_этапа]")
+        return
+    if not 1 <= stage <= bot.last_stage:
+        await reply_text(update.message, f"Этап должен быть от 1 до {bot.last_stage}")
+        return
+    campaign_id = broadcaster.start(stage, from_stage)
+    await reply_text(update.message, f"🚀 Рассылка {campaign_id} запущена: этап {stage}")
+
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /broadcast_status <id> (только для админов)"""
+    if not is_admin(update.effective_user):
+        return
+    try:
+        campaign_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await reply_text(update.message, "Использование: /broadcast_status <id>")
+        return
+    stats = broadcaster.checkpoint.stats(campaign_id)
+    await reply_text(update.message, f"📊 Рассылка {campaign_id}: {stats or 'нет данных'}")
+
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /broadcast_cancel <id> (только для админов)"""
+    if not is_admin(update.effective_user):
+        return
+    try:
+        campaign_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await reply_text(update.message, "Использование: /broadcast_cancel <id>")
+        return
+    if broadcaster.cancel(campaign_id):
+        await reply_text(update.message, f"⏹ Рассылка {campaign_id} остановлена")
+    else:
+        await reply_text(update.message, f"Рассылка {campaign_id} не выполняется")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /stats [дней] (только для админов)"""
+    if not is_admin(update.effective_user):
+        return
+    try:
+        days = int(context.args[0]) if context.args else 7
+    except ValueError:
+        await reply_text(update.message, "Использование: /stats [дней]")
+        return
+    # Счетчики ведет только хранилище SQLite
+    if not bot.store.has_stats:
+        await reply_text(update.message, "Статистика воронки доступна только с USER_STORE=sqlite")
+        return
+    totals, daily = bot.funnel_stats(max(days, 1))
+    await reply_text(update.message, format_funnel_stats(totals, daily, bot.last_stage))
+
+async def watch_templates(interval):
+    """Периодически проверяет mtime шаблонов и перезагружает измененные"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if bot.templates.refresh():
+                log.info("✓ Шаблоны перезагружены, версия %s", bot.templates.version)
+        except Exception as e:
+            ERRORS.inc(where='templates')
+            log.error("✗ Ошибка перезагрузки шаблонов: %s", e)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
-    print(f"Update {update} caused error {context.error}")
+    ERRORS.inc(where='handler')
+    log.error("Update %s caused error %s", update, context.error, exc_info=context.error)
+
+async def handle_metrics(request):
+    """GET /metrics в формате Prometheus"""
+    return Response(200, REGISTRY.render(), METRICS_CONTENT_TYPE)
+
+async def on_startup(app):
+    """Поднимает воркеры рендеринга, метрики, наблюдение за шаблонами, рассылки и автоотправку до приема первых обновлений"""
+    global broadcaster, drip, prerenderer, metrics_server
+    await render_pool.warm_up()
+    send_queue.start()
+    # Отдельный порт для /metrics (в режиме webhook /metrics есть и на основном сервере)
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        metrics_server = HttpServer(os.getenv("METRICS_LISTEN", "0.0.0.0"), int(metrics_port))
+        metrics_server.route('GET', '/metrics', handle_metrics)
+        await metrics_server.start()
+    interval = float(os.getenv("TEMPLATE_RELOAD_INTERVAL", "5"))
+    if interval > 0:
+        background_tasks.append(asyncio.create_task(watch_templates(interval)))
+    prerenderer = Prerenderer.from_env(prerender_stage)
+    if prerenderer is not None:
+        background_tasks.append(asyncio.create_task(prerenderer.run()))
+    
+    async def broadcast_send(telegram_id, stage, user_name):
+        await deliver_stage(app.bot, int(telegram_id), stage, user_name, 'broadcast')
+        # Пользователь продолжит воронку с этапа из рассылки
+        bot.update_user_stage(telegram_id, stage)
+        if drip is not None:
+            drip.schedule_after(telegram_id, stage, user_name)
+    
+    broadcaster = Broadcaster(
+        bot.store,
+        BroadcastCheckpoint(os.getenv("BROADCAST_DB_PATH", "broadcasts.db")),
+        broadcast_send,
+        rate=float(os.getenv("BROADCAST_RATE", "25")),
+        concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "10")),
+    )
+    # Прерванные рассылки и таймеры обслуживает один процесс
+    primary = WORKER_INDEX == 0
+    if primary:
+        resumed = broadcaster.resume_all()
+        if resumed:
+            log.info("✓ Продолжены рассылки: %s", resumed)
+    
+    async def drip_send(telegram_id, stage, user_name):
+        await deliver_stage(app.bot, int(telegram_id), stage, user_name, 'drip')
+    
+    # Таймеры хранятся в колонке next_send_at, поэтому нужно хранилище SQLite
+    if bot.store.has_timers:
+        drip = DripScheduler.from_env(bot.store, drip_send, lambda: bot.last_stage)
+        # Остальные воркеры только записывают таймеры своих пользователей в базу
+        if drip is not None and primary:
+            background_tasks.append(asyncio.create_task(drip.run()))
+            log.info("✓ Автоотправка этапов включена: %s", drip.delays)
+    elif os.getenv("DRIP_DELAYS"):
+        log.warning("⚠️ Автоотправка этапов работает только с USER_STORE=sqlite")
+
+async def on_shutdown(app):
+    """Останавливает фоновые задачи, воркеры рендеринга и закрывает хранилище"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if broadcaster is not None:
+        await broadcaster.stop()
+        broadcaster.checkpoint.close()
+    # Рассылки остановлены раньше: их получатели не останутся «sending»
+    await send_queue.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    render_pool.shutdown()
+    bot.store.close()
 
 async def clear_webhook(app):
     """Принудительно очищает webhook перед polling"""
     try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        print("✅ Webhook очищен")
+        # Соединения закрываются вместе с этим event loop, polling откроет свои
+        async with app.bot:
+            await app.bot.delete_webhook(drop_pending_updates=True)
+        log.info("✅ Webhook очищен")
     except Exception as e:
-        print(f"⚠️ Ошибка очистки webhook: {e}")
+        log.warning("⚠️ Ошибка очистки webhook: %s", e)
+
+def stop_event():
+    """Event, который выставляется по SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+def webhook_settings():
+    """Адрес, путь и секрет webhook из WEBHOOK_URL / WEBHOOK_PATH / WEBHOOK_SECRET"""
+    base_url = os.getenv("WEBHOOK_URL", "").rstrip('/')
+    if not base_url:
+        raise RuntimeError("WEBHOOK_URL не установлен для режима webhook")
+    path = os.getenv("WEBHOOK_PATH", "/telegram")
+    # Без заданного секрета генерируем новый на каждый запуск
+    secret = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+    return base_url, path, secret
+
+def secret_matches(value, secret):
+    """Сравнение секрета из заголовка за постоянное время"""
+    return value is not None and secrets.compare_digest(value.encode('latin-1'), secret.encode('utf-8'))
+
+def webhook_handler(secret, deliver):
+    """POST от Telegram: проверка секрета и передача JSON обновления в deliver(data)"""
+    async def handle_update(request):
+        if not secret_matches(request.headers.get('x-telegram-bot-api-secret-token'), secret):
+            return Response(403, 'forbidden')
+        try:
+            data = request.json()
+            if not isinstance(data, dict):
+                raise ValueError("update must be an object")
+            await deliver(data)
+        except (ValueError, TypeError, KeyError):
+            return Response(400, 'bad update')
+        return Response(200, 'ok')
+    return handle_update
+
+async def serve_application(app, server, after_start=None):
+    """Обрабатывает обновления приложением, пока работает HTTP сервер (до SIGINT/SIGTERM)"""
+    stop = stop_event()
+    async with app:
+        await on_startup(app)
+        await app.start()
+        try:
+            await server.start()
+            if after_start is not None:
+                await after_start()
+            await stop.wait()
+        finally:
+            await server.stop()
+            await app.stop()
+            await on_shutdown(app)
+
+async def run_webhook(app):
+    """Принимает обновления через webhook на встроенном HTTP сервере"""
+    base_url, path, secret = webhook_settings()
+    server = HttpServer(os.getenv("WEBHOOK_LISTEN", "0.0.0.0"), int(os.getenv("PORT", "8080")))
+    
+    async def enqueue(data):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    
+    async def handle_health(request):
+        return Response.json({'status': 'ok', 'running': app.running})
+    
+    server.route('POST', path, webhook_handler(secret, enqueue))
+    server.route('GET', '/health', handle_health)
+    server.route('GET', '/metrics', handle_metrics)
+    
+    async def register_webhook():
+        await app.bot.set_webhook(
+            url=base_url + path,
+            secret_token=secret,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True
+        )
+        log.info("🚀 Бот запущен в WEBHOOK режиме: %s%s", base_url, path)
+    
+    await serve_application(app, server, register_webhook)
+
+async def run_worker(app):
+    """Воркер: обрабатывает обновления, которые раздает ingress процесс"""
+    server = HttpServer(
+        os.getenv("WEBHOOK_LISTEN", "0.0.0.0"), int(os.getenv("PORT", "8080")),
+        unix_socket=os.getenv("WORKER_SOCKET")
+    )
+    secret = os.getenv("WORKER_SECRET")
+    
+    async def handle_updates(request):
+        if secret and not secret_matches(request.headers.get(WORKER_SECRET_HEADER.lower()), secret):
+            return Response(403, 'forbidden')
+        try:
+            items = request.json()
+            if not isinstance(items, list):
+                items = [items]
+            updates = [Update.de_json(item, app.bot) for item in items]
+        except (ValueError, TypeError, KeyError):
+            return Response(400, 'bad updates')
+        # Порядок сохраняется: ingress присылает обновления пользователя по очереди
+        for update in updates:
+            await app.update_queue.put(update)
+        return Response(200, 'ok')
+    
+    async def handle_health(request):
+        return Response.json({'status': 'ok', 'worker': WORKER_INDEX, 'running': app.running})
+    
+    server.route('POST', '/updates', handle_updates)
+    server.route('GET', '/health', handle_health)
+    server.route('GET', '/metrics', handle_metrics)
+    
+    async def announce():
+        log.info("🚀 Воркер %s готов принимать обновления", WORKER_INDEX)
+    
+    await serve_application(app, server, announce)
+
+async def poll_updates(tg_bot, router):
+    """Long polling без обработчиков: каждое обновление передается воркеру"""
+    offset = None
+    timeout = int(os.getenv("POLL_TIMEOUT", "25"))
+    while True:
+        try:
+            updates = await tg_bot.get_updates(offset=offset, timeout=timeout, allowed_updates=ALLOWED_UPDATES)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+            continue
+        except TelegramError as e:
+            log.warning("⚠️ Ошибка getUpdates: %s", e)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await router.dispatch(update.to_dict())
+            offset = update.update_id + 1
+
+def worker_count():
+    """BOT_WORKERS: число воркеров, auto — по числу ядер, 0 — один процесс"""
+    value = os.getenv("BOT_WORKERS", "0").strip().lower()
+    if value == "auto":
+        return os.cpu_count() or 1
+    return int(value or 0)
+
+async def run_ingress(app, mode):
+    """Ingress: получает обновления (polling или webhook) и раздает их воркерам по telegram_id"""
+    worker_urls = [url.strip() for url in os.getenv("BOT_WORKER_URLS", "").split(",") if url.strip()]
+    secret = os.getenv("WORKER_SECRET")
+    local_workers = None
+    if not worker_urls:
+        # Локальные воркеры на unix сокетах со случайным общим секретом
+        secret = secret or secrets.token_urlsafe(32)
+        local_workers = LocalWorkers(
+            worker_count(), str(Path(__file__).resolve()), os.getenv("WORKER_SOCKET_DIR"),
+            env={**os.environ, 'WORKER_SECRET': secret}
+        )
+        worker_urls = local_workers.endpoints
+    router = UpdateRouter(worker_urls, secret, ADMIN_IDS)
+    stop = stop_event()
+    
+    async with app.bot:
+        if local_workers is not None:
+            await local_workers.start()
+        await router.start()
+        try:
+            if mode == "webhook":
+                base_url, path, webhook_secret = webhook_settings()
+                server = HttpServer(os.getenv("WEBHOOK_LISTEN", "0.0.0.0"), int(os.getenv("PORT", "8080")))
+                
+                async def handle_health(request):
+                    return Response.json({'status': 'ok', 'workers': len(worker_urls)})
+                
+                server.route('POST', path, webhook_handler(webhook_secret, router.dispatch))
+                server.route('GET', '/health', handle_health)
+                try:
+                    await server.start()
+                    await app.bot.set_webhook(
+                        url=base_url + path,
+                        secret_token=webhook_secret,
+                        allowed_updates=ALLOWED_UPDATES,
+                        drop_pending_updates=True
+                    )
+                    log.info("🚀 Ingress в WEBHOOK режиме: %s%s, воркеров: %s", base_url, path, len(worker_urls))
+                    await stop.wait()
+                finally:
+                    await server.stop()
+            else:
+                await app.bot.delete_webhook(drop_pending_updates=True)
+                poller = asyncio.create_task(poll_updates(app.bot, router))
+                log.info("🚀 Ingress в POLLING режиме, воркеров: %s", len(worker_urls))
+                await stop.wait()
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+        finally:
+            await router.stop()
+            if local_workers is not None:
+                await local_workers.stop()
+
+def build_application(token):
+    """Создает приложение с обработчиками"""
+    builder = Application.builder().token(token)
+    # Свой сервер Bot API (локальный сервер или заглушка для тестов)
+    api_url = os.getenv("BOT_API_URL")
+    if api_url:
+        builder = builder.base_url(f"{api_url.rstrip('/')}/bot").base_file_url(f"{api_url.rstrip('/')}/file/bot")
+    # Обновления разных пользователей обрабатываются параллельно, одного — по очереди
+    builder = builder.concurrent_updates(PerUserUpdateProcessor.from_env())
+    # Соединения переиспользуются (keep-alive); запросов одновременно не больше SEND_CONCURRENCY,
+    # поэтому пула хватает, а при его нехватке запрос ждет соединение, а не падает через секунду
+    builder = builder.connection_pool_size(int(os.getenv("TELEGRAM_POOL_SIZE", "64"))).pool_timeout(
+        float(os.getenv("TELEGRAM_POOL_TIMEOUT", "10"))
+    )
+    app = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
+    
+    # Добавляем обработчики
+    app.add_handler(CommandHandler("start", start_command))
+    app.add_handler(CommandHandler("reload_templates", reload_templates_command))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CallbackQueryHandler(button_handler))
+    app.add_error_handler(error_handler)
+    return app
 
 def main():
     """Запуск бота"""
+    setup_logging()
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     
     if not BOT_TOKEN or BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        print("❌ Ошибка: BOT_TOKEN не установлен в файле .env")
-        print("Пожалуйста, добавьте ваш токен бота в файл .env")
+        log.error("❌ Ошибка: BOT_TOKEN не установлен в файле .env")
+        log.error("Пожалуйста, добавьте ваш токен бота в файл .env")
         return
     
-    # Создаем приложение для Railway с принудительным polling
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = build_application(BOT_TOKEN)
     
-    # Добавляем обработчики
-    app.add_handler(CommandHandler("start", start_command))
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_error_handler(error_handler)
+    # Режим получения обновлений: polling (по умолчанию), webhook или worker
+    mode = os.getenv("BOT_MODE", "polling").lower()
+    if mode == "worker":
+        asyncio.run(run_worker(app))
+        return
+    if mode not in ("polling", "webhook"):
+        log.error("❌ Неизвестный BOT_MODE: %s", mode)
+        return
+    # С BOT_WORKERS этот процесс только принимает обновления и раздает их воркерам
+    if worker_count() > 0 or os.getenv("BOT_WORKER_URLS"):
+        asyncio.run(run_ingress(app, mode))
+        return
+    if mode == "webhook":
+        asyncio.run(run_webhook(app))
+        return
     
-    print("🚀 Бот запущен в POLLING режиме для Railway!")
-    print("📡 Принудительное использование polling (без webhook)")
+    log.info("🚀 Бот запущен в POLLING режиме для Railway!")
     
-    # Принудительно используем только polling для Railway
     try:
         # Очищаем webhook перед запуском polling
-        import asyncio
         asyncio.run(clear_webhook(app))
         
-        # Запускаем только polling
+        # Запускаем polling
         app.run_polling(
             drop_pending_updates=True,  # Очищаем конфликтующие обновления
-            allowed_updates=["message", "callback_query"]  # Только нужные типы
+            allowed_updates=ALLOWED_UPDATES  # Только нужные типы
         )
     except Exception as e:
-        print(f"❌ Критическая ошибка polling: {e}")
+        log.critical("❌ Критическая ошибка polling: %s", e)
         raise
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import parse_qs, urlsplit
+
+log = logging.getLogger(__name__)
+
+# Ограничение на размер тела запроса (обновления Telegram заметно меньше)
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADERS = 100
+# Сколько ждать запрос целиком; столько же живет простаивающее keep-alive соединение
+READ_TIMEOUT = 30
+
+STATUS_TEXT = {
+    200: 'OK', 204: 'No Content', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests',
+    431: 'Request Header Fields Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = parse_qs(parts.query)
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b'null')
+
+
+class Response:
+    def __init__(self, status=200, body=b'', content_type='text/plain; charset=utf-8', headers=None):
+        self.status = status
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, data, status=200):
+        return cls(status, json.dumps(data, ensure_ascii=False), 'application/json')
+
+
+class HttpServer:
+    """Минимальный HTTP/1.1 сервер на asyncio для webhook, health и служебных ручек"""
+
+    def __init__(self, host='0.0.0.0', port=8080, unix_socket=None, max_body_size=MAX_BODY_SIZE,
+                 read_timeout=READ_TIMEOUT):
+        self.host = host
+        self.port = port
+        # Путь unix сокета вместо TCP (связь процессов на одной машине)
+        self.unix_socket = unix_socket
+        self.max_body_size = max_body_size
+        self.read_timeout = read_timeout
+        self._routes = {}
+        self._server = None
+
+    def route(self, method, path, handler):
+        """Регистрирует async handler(request) -> Response"""
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        if self.unix_socket:
+            # Сокет от прошлого запуска мешает bind
+            if os.path.exists(self.unix_socket):
+                os.unlink(self.unix_socket)
+            self._server = await asyncio.start_unix_server(self._handle_connection, self.unix_socket)
+            log.info("✓ HTTP сервер слушает %s", self.unix_socket)
+            return
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # При port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        log.info("✓ HTTP сервер слушает %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                # Недосланный запрос не держит соединение вечно
+                request = await asyncio.wait_for(self._read_request(reader), self.read_timeout)
+                if request is None:
+                    break
+                if isinstance(request, Response):
+                    await self._write_response(writer, request, keep_alive=False)
+                    break
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        try:
+            line = await reader.readline()
+        except ValueError:
+            return Response(400, 'request line too long')
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            return Response(400, 'bad request line')
+        headers = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # Строка длиннее буфера StreamReader
+                return Response(431, 'header line too long')
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                return Response(431, 'too many headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            return Response(400, 'bad content-length')
+        if length < 0:
+            return Response(400, 'bad content-length')
+        if length > self.max_body_size:
+            return Response(413, 'payload too large')
+        body = await reader.readexactly(length) if length else b''
+        return Request(method.upper(), target, headers, body)
+
+    async def _dispatch(self, request):
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return Response(405, 'method not allowed')
+            return Response(404, 'not found')
+        try:
+            return await handler(request)
+        except Exception:
+            log.exception("✗ Ошибка обработки %s %s", request.method, request.path)
+            return Response(500, 'internal error')
+
+    async def _write_response(self, writer, response, keep_alive):
+        head = [
+            f"HTTP/1.1 {response.status} {STATUS_TEXT.get(response.status, 'OK')}",
+            f"Content-Type: {response.content_type}",
+            f"Content-Length: {len(response.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        head.extend(f"{name}: {value}" for name, value in response.headers.items())
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response.body)
+        await writer.drain()
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+from pathlib import Path
+
+import httpx
+
+log = logging.getLogger(__name__)
+
+# Заголовок с общим секретом между ingress и воркерами
+WORKER_SECRET_HEADER = 'X-Worker-Secret'
+
+
+def update_shard_key(data):
+    """telegram_id отправителя из JSON обновления (chat.id или update_id, если его нет)"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get('from')
+        if isinstance(sender, dict) and 'id' in sender:
+            return int(sender['id'])
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return int(chat['id'])
+    return int(data.get('update_id', 0))
+
+
+def shard_for(telegram_id, count, admin_ids=()):
+    """Номер воркера для пользователя; администраторы всегда на воркере 0
+
+    Служебные команды (рассылки) так попадают в один процесс с фоновыми задачами.
+    """
+    if telegram_id in admin_ids:
+        return 0
+    return telegram_id % count
+
+
+def make_client(endpoint, timeout=30.0):
+    """HTTP клиент воркера: 'unix:/path/to.sock' или 'http://host:port'"""
+    if endpoint.startswith('unix:'):
+        transport = httpx.AsyncHTTPTransport(uds=endpoint[len('unix:'):])
+        return httpx.AsyncClient(transport=transport, base_url='http://worker', timeout=timeout)
+    return httpx.AsyncClient(base_url=endpoint, timeout=timeout)
+
+
+class UpdateRouter:
+    """Раздает обновления воркерам по telegram_id
+
+    У каждого воркера своя очередь и один отправитель, поэтому обновления
+    одного пользователя приходят в воркер в исходном порядке. Накопившиеся
+    обновления отправляются одним запросом (до batch_size штук).
+    """
+
+    def __init__(self, endpoints, secret=None, admin_ids=(), batch_size=100, queue_size=10000):
+        if not endpoints:
+            raise ValueError("Нужен хотя бы один воркер")
+        self.endpoints = list(endpoints)
+        self.secret = secret
+        self.admin_ids = set(admin_ids)
+        self.batch_size = batch_size
+        self._queues = [asyncio.Queue(queue_size) for _ in self.endpoints]
+        self._clients = []
+        self._tasks = []
+
+    async def start(self):
+        self._clients = [make_client(endpoint) for endpoint in self.endpoints]
+        self._tasks = [
+            asyncio.create_task(self._sender(index)) for index in range(len(self.endpoints))
+        ]
+
+    async def dispatch(self, data):
+        """Ставит обновление (dict из JSON) в очередь его воркера"""
+        index = shard_for(update_shard_key(data), len(self.endpoints), self.admin_ids)
+        await self._queues[index].put(data)
+
+    async def stop(self, timeout=10.0):
+        """Дожидается отправки очередей (не дольше timeout) и закрывает соединения"""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)), timeout
+            )
+        except asyncio.TimeoutError:
+            log.warning("⚠️ Не все обновления переданы воркерам до остановки")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for client in self._clients:
+            await client.aclose()
+
+    async def _sender(self, index):
+        queue = self._queues[index]
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            status = await self._deliver(index, batch)
+            # 403 (чужой секрет) не исправит и отправка по одному
+            if status != 200 and len(batch) > 1 and status != 403:
+                # Воркер не принял пакет целиком: отбрасываем только испорченные обновления
+                for update in batch:
+                    status = await self._deliver(index, [update])
+                    if status != 200:
+                        log.error("✗ Воркер %s отклонил обновление %s (%s), оно пропущено",
+                                  index, update.get('update_id'), status)
+            elif status != 200:
+                log.error("✗ Воркер %s отклонил пакет из %s обновлений (%s), он пропущен",
+                          index, len(batch), status)
+            for _ in batch:
+                queue.task_done()
+
+    async def _deliver(self, index, batch):
+        """Отправляет пакет воркеру и возвращает статус ответа
+
+        Сетевые ошибки и 5xx повторяются, пока воркер не ответит: он может
+        перезапускаться. Ответ 4xx означает, что повтор не поможет.
+        """
+        client = self._clients[index]
+        headers = {WORKER_SECRET_HEADER: self.secret} if self.secret else {}
+        delay = 0.1
+        while True:
+            try:
+                response = await client.post('/updates', json=batch, headers=headers)
+                if response.status_code < 500:
+                    return response.status_code
+                log.warning("⚠️ Воркер %s ответил %s", index, response.status_code)
+            except httpx.HTTPError as e:
+                # Первые неудачи — обычно воркер еще запускается
+                log.log(logging.WARNING if delay >= 1.0 else logging.DEBUG,
+                        "⚠️ Воркер %s недоступен: %s", index, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+
+class LocalWorkers:
+    """Запускает count воркеров-процессов на этой машине и перезапускает упавшие
+
+    Воркеры слушают unix сокеты в socket_dir и получают номер через WORKER_INDEX.
+    """
+
+    def __init__(self, count, script, socket_dir=None, env=None):
+        self.count = count
+        self.script = script
+        # Временный каталог сокетов удаляется при остановке
+        self._own_socket_dir = socket_dir is None
+        self.socket_dir = Path(socket_dir or tempfile.mkdtemp(prefix='funnel-workers-'))
+        self.env = dict(env if env is not None else os.environ)
+        self._processes = [None] * count
+        self._monitor = None
+        self._stopping = False
+
+    @property
+    def endpoints(self):
+        return [f"unix:{self.socket_path(index)}" for index in range(self.count)]
+
+    def socket_path(self, index):
+        return self.socket_dir / f"worker{index}.sock"
+
+    def worker_env(self, index):
+        env = dict(self.env)
+        env.update({
+            'BOT_MODE': 'worker',
+            'WORKER_INDEX': str(index),
+            'WORKER_COUNT': str(self.count),
+            'WORKER_SOCKET': str(self.socket_path(index)),
+        })
+        # Ядра делятся между воркерами, а не заняты пулом рендеринга каждого
+        env.setdefault('RENDER_WORKERS', str(max(1, (os.cpu_count() or 1) // self.count)))
+        # Сервер метрик на отдельном порту у каждого воркера
+        if env.get('METRICS_PORT'):
+            env['METRICS_PORT'] = str(int(env['METRICS_PORT']) + 1 + index)
+        return env
+
+    async def start(self):
+        self.socket_dir.mkdir(parents=True, exist_ok=True)
+        for index in range(self.count):
+            await self._spawn(index)
+        self._monitor = asyncio.create_task(self._watch())
+
+    async def _spawn(self, index):
+        self._processes[index] = await asyncio.create_subprocess_exec(
+            sys.executable, self.script, env=self.worker_env(index)
+        )
+        log.info("✓ Воркер %s запущен (pid %s)", index, self._processes[index].pid)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self._processes):
+                if process.returncode is not None and not self._stopping:
+                    log.error("✗ Воркер %s завершился с кодом %s, перезапуск", index, process.returncode)
+                    await self._spawn(index)
+
+    async def stop(self, timeout=30.0):
+        """Останавливает воркеры через SIGTERM (они доделывают текущие обновления)"""
+        self._stopping = True
+        if self._monitor is not None:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+        running = [p for p in self._processes if p is not None and p.returncode is None]
+        for process in running:
+            process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in running)), timeout)
+        except asyncio.TimeoutError:
+            for process in running:
+                if process.returncode is None:
+                    process.kill()
+        if self._own_socket_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
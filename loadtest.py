@@ -0,0 +1,411 @@
+"""Нагрузочный тест бота без Telegram: заглушка Bot API и поток пользователей
+
+    python loadtest.py                                  # 1000 пользователей, 50 в секунду
+    python loadtest.py --users 5000 --rate 200 --latency 0.05 --error-rate 0.01
+    python loadtest.py --bot-env BOT_WORKERS=4 --output load.json
+    python loadtest.py --no-bot --port 8081             # бот запущен вручную с BOT_API_URL
+
+Бот запускается отдельным процессом в режиме polling с BOT_API_URL, который
+указывает на заглушку. Каждый пользователь отправляет /start и нажимает
+«Далее», пока не получит последний этап. Задержка — время от появления
+обновления в getUpdates до ответа заглушки на sendPhoto с этапом.
+
+Результат — JSON: пропускная способность, статистика задержек (как в
+benchmark.py) и счетчики вызовов Bot API.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import signal
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from http_server import HttpServer, Response
+from perf_report import run_info, summarize
+
+ROOT = Path(__file__).resolve().parent
+
+RESULTS_VERSION = 1
+
+# Методы, которые заглушка отклоняет с 429 при --error-rate
+DEFAULT_ERROR_METHODS = 'sendPhoto,sendMessage,editMessageCaption'
+
+
+def form_fields(request):
+    """Поля запроса Bot API: multipart (загрузка фото), JSON или urlencoded
+
+    Содержимое файлов не разбирается — вместо него подставляется размер.
+    """
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode('latin-1')
+        fields = {}
+        for part in request.body.split(b'--' + boundary)[1:-1]:
+            head, _, value = part.partition(b'\r\n\r\n')
+            name = re.search(rb'name="([^"]*)"', head)
+            if name is None:
+                continue
+            value = value[:-2] if value.endswith(b'\r\n') else value
+            if b'filename=' in head:
+                fields[name.group(1).decode()] = len(value)
+            else:
+                fields[name.group(1).decode()] = value.decode('utf-8')
+        return fields
+    if 'json' in content_type:
+        return request.json() or {}
+    return {key: values[0] for key, values in parse_qs(request.body.decode('utf-8')).items()}
+
+
+class FakeBotApi:
+    """Заглушка Bot API: очередь обновлений для getUpdates и ответы на отправки
+
+    latency (+ случайная добавка до jitter) — задержка каждого ответа,
+    error_rate — доля ответов 429 с retry_after для методов error_methods.
+    Сообщения бота складываются во входящие пользователя (inbox).
+    """
+
+    def __init__(self, token, latency=0.0, jitter=0.0, error_rate=0.0, retry_after=1,
+                 error_methods=DEFAULT_ERROR_METHODS.split(',')):
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.error_methods = set(error_methods)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.polling = asyncio.Event()
+        self._updates = deque()
+        self._next_update_id = 1
+        self._new_updates = asyncio.Event()
+        self._closed = False
+        self._inboxes = {}
+        self._message_id = 0
+        self._file_id = 0
+
+    def routes(self, server):
+        handlers = {
+            'getMe': self.get_me,
+            'getUpdates': self.get_updates,
+            'sendPhoto': self.send_photo,
+            'sendMessage': self.send_message,
+            'answerCallbackQuery': self.answer_callback_query,
+            'editMessageCaption': self.edit_message_caption,
+            'deleteWebhook': self.ok,
+            'setWebhook': self.ok,
+            'getWebhookInfo': self.get_webhook_info,
+        }
+        for method, handler in handlers.items():
+            server.route('POST', f"/bot{self.token}/{method}", self._wrap(method, handler))
+
+    def inbox(self, chat_id):
+        """Очередь сообщений, отправленных ботом в чат"""
+        inbox = self._inboxes.get(chat_id)
+        if inbox is None:
+            inbox = self._inboxes[chat_id] = asyncio.Queue()
+        return inbox
+
+    def push(self, update):
+        """Добавляет обновление, его получит следующий getUpdates"""
+        update['update_id'] = self._next_update_id
+        self._next_update_id += 1
+        self._updates.append(update)
+        self._new_updates.set()
+
+    def close(self):
+        """Отпускает ждущие getUpdates перед остановкой сервера"""
+        self._closed = True
+        self._new_updates.set()
+
+    def _wrap(self, method, handler):
+        async def handle(request):
+            self.calls[method] += 1
+            if method != 'getUpdates':
+                delay = self.latency + random.uniform(0, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if method in self.error_methods and random.random() < self.error_rate:
+                    self.errors[method] += 1
+                    return Response.json({
+                        'ok': False,
+                        'error_code': 429,
+                        'description': f"Too Many Requests: retry after {self.retry_after}",
+                        'parameters': {'retry_after': self.retry_after},
+                    }, status=429)
+            result = await handler(form_fields(request))
+            return Response.json({'ok': True, 'result': result})
+        return handle
+
+    async def ok(self, fields):
+        return True
+
+    async def get_me(self, fields):
+        return {'id': 1, 'is_bot': True, 'first_name': 'Load test', 'username': 'loadtest_bot'}
+
+    async def get_webhook_info(self, fields):
+        return {'url': '', 'has_custom_certificate': False, 'pending_update_count': len(self._updates)}
+
+    async def get_updates(self, fields):
+        self.polling.set()
+        offset = int(fields.get('offset') or 0)
+        limit = int(fields.get('limit') or 100)
+        # Подтвержденные обновления (update_id < offset) больше не нужны
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates and not self._closed:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(fields.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    def _message(self, fields, **extra):
+        self._message_id += 1
+        chat_id = int(fields['chat_id'])
+        message = {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            **extra,
+        }
+        if fields.get('reply_markup'):
+            message['reply_markup'] = json.loads(fields['reply_markup'])
+        return message
+
+    async def send_photo(self, fields):
+        photo = fields.get('photo')
+        if isinstance(photo, int):
+            # Загружен файл — выдаем новый file_id, как Telegram
+            self._file_id += 1
+            photo = f"loadtest-photo-{self._file_id}"
+        message = self._message(fields, caption=fields.get('caption', ''), photo=[
+            {'file_id': photo, 'file_unique_id': photo, 'width': 1080, 'height': 1080}
+        ])
+        self.inbox(message['chat']['id']).put_nowait(('photo', time.perf_counter(), message))
+        return message
+
+    async def send_message(self, fields):
+        message = self._message(fields, text=fields.get('text', ''))
+        self.inbox(message['chat']['id']).put_nowait(('text', time.perf_counter(), message))
+        return message
+
+    async def answer_callback_query(self, fields):
+        return True
+
+    async def edit_message_caption(self, fields):
+        return self._message(fields, caption=fields.get('caption', ''))
+
+
+def next_button(message):
+    """callback_data кнопки «Далее» или None на последнем этапе"""
+    for row in (message.get('reply_markup') or {}).get('inline_keyboard', []):
+        for button in row:
+            if button.get('callback_data'):
+                return button['callback_data']
+    return None
+
+
+class User:
+    """Пользователь, который проходит воронку от /start до последнего этапа"""
+
+    def __init__(self, api, user_id, think_time, timeout):
+        self.api = api
+        self.user_id = user_id
+        self.think_time = think_time
+        self.timeout = timeout
+        self.inbox = api.inbox(user_id)
+        self.sender = {'id': user_id, 'is_bot': False, 'first_name': f"Гость{user_id % 1000}"}
+
+    def _chat(self):
+        return {'id': self.user_id, 'type': 'private'}
+
+    async def run(self, results):
+        self.api.push({'message': {
+            'message_id': 1, 'date': int(time.time()), 'chat': self._chat(), 'from': self.sender,
+            'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        }})
+        message = await self._wait('start', results)
+        while message is not None:
+            data = next_button(message)
+            if data is None:
+                results['completed'] += 1
+                return
+            await asyncio.sleep(random.uniform(0, 2 * self.think_time))
+            self.api.push({'callback_query': {
+                'id': f"{self.user_id}-{message['message_id']}", 'chat_instance': str(self.user_id),
+                'from': self.sender, 'data': data,
+                'message': {'message_id': message['message_id'], 'date': message['date'], 'chat': self._chat()},
+            }})
+            message = await self._wait('next', results)
+
+    async def _wait(self, action, results):
+        """Ждет фото этапа; ошибка бота или таймаут прерывают путь пользователя"""
+        started = time.perf_counter()
+        try:
+            kind, received, message = await asyncio.wait_for(self.inbox.get(), self.timeout)
+        except asyncio.TimeoutError:
+            results['timeouts'] += 1
+            return None
+        if kind != 'photo':
+            results['bot_errors'] += 1
+            return None
+        results['latency'][action].append(received - started)
+        return message
+
+
+async def generate(api, args):
+    """Запускает пользователей с частотой args.rate и ждет, пока все закончат"""
+    results = {'latency': {'start': [], 'next': []}, 'completed': 0, 'timeouts': 0, 'bot_errors': 0}
+    tasks = []
+    started = time.perf_counter()
+    for index in range(args.users):
+        # Пуассоновский поток: случайные интервалы со средним 1 / rate
+        await asyncio.sleep(random.expovariate(args.rate))
+        user = User(api, args.first_user_id + index, args.think_time, args.timeout)
+        tasks.append(asyncio.create_task(user.run(results)))
+    await asyncio.gather(*tasks)
+    results['elapsed'] = time.perf_counter() - started
+    return results
+
+
+def start_bot(args, api_url, workdir):
+    """Запускает funnel_bot.py в режиме polling с заглушкой вместо Telegram"""
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': args.token,
+        'BOT_MODE': 'polling',
+        'BOT_API_URL': api_url,
+        'USER_DB_PATH': str(workdir / 'users.db'),
+        'USER_CSV_PATH': str(workdir / 'users_data.csv'),
+        'BROADCAST_DB_PATH': str(workdir / 'broadcasts.db'),
+        'METRICS_PORT': '',
+    })
+    for item in args.bot_env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    log_file = open(workdir / 'bot.log', 'wb')
+    return asyncio.create_subprocess_exec(
+        sys.executable, str(ROOT / 'funnel_bot.py'), cwd=ROOT, env=env,
+        stdout=log_file, stderr=log_file
+    )
+
+
+async def run(args):
+    api = FakeBotApi(
+        args.token, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        retry_after=args.retry_after, error_methods=args.error_methods.split(','),
+    )
+    # Фото приходят в теле запроса
+    server = HttpServer('127.0.0.1', args.port, max_body_size=64 * 1024 * 1024)
+    api.routes(server)
+    await server.start()
+    api_url = f"http://127.0.0.1:{server.port}"
+    bot = None
+    workdir = Path(tempfile.mkdtemp(prefix='funnel-loadtest-'))
+    try:
+        if args.no_bot:
+            print(f"Заглушка Bot API: BOT_API_URL={api_url} BOT_TOKEN={args.token}", file=sys.stderr)
+        else:
+            bot = await start_bot(args, api_url, workdir)
+        try:
+            await asyncio.wait_for(api.polling.wait(), args.startup_timeout)
+        except asyncio.TimeoutError:
+            raise SystemExit(f"✗ Бот не начал polling за {args.startup_timeout} с, лог: {workdir / 'bot.log'}")
+        print(f"🚀 {args.users} пользователей, {args.rate}/с", file=sys.stderr)
+        results = await generate(api, args)
+    finally:
+        if bot is not None and bot.returncode is None:
+            bot.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(bot.wait(), 30)
+            except asyncio.TimeoutError:
+                bot.kill()
+        api.close()
+        await asyncio.sleep(0.1)
+        await server.stop()
+    results['calls'] = dict(api.calls)
+    results['injected_429'] = dict(api.errors)
+    results['bot_log'] = str(workdir / 'bot.log')
+    return results
+
+
+def report(args, results):
+    latency = results['latency']
+    photos = len(latency['start']) + len(latency['next'])
+    return {
+        'version': RESULTS_VERSION,
+        **run_info(),
+        'config': {
+            'users': args.users, 'rate': args.rate, 'think_time': args.think_time,
+            'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+            'bot_env': args.bot_env,
+        },
+        'throughput': {
+            'elapsed_s': results['elapsed'],
+            'completed_users': results['completed'],
+            'photos_per_sec': photos / results['elapsed'] if results['elapsed'] else None,
+        },
+        'results': {action: summarize(samples) for action, samples in latency.items() if samples},
+        'failures': {'timeouts': results['timeouts'], 'bot_errors': results['bot_errors']},
+        'calls': results['calls'],
+        'injected_429': results['injected_429'],
+        'bot_log': results['bot_log'],
+    }
+
+
+def print_summary(data):
+    throughput = data['throughput']
+    print(f"✓ Завершили воронку: {throughput['completed_users']}/{data['config']['users']} "
+          f"за {throughput['elapsed_s']:.1f} с, {throughput['photos_per_sec']:.1f} фото/с", file=sys.stderr)
+    for action, stats in data['results'].items():
+        print(f"  {action:<6} n={stats['n']:<6} p50 {stats['p50_ms']:8.1f} мс  "
+              f"p99 {stats['p99_ms']:8.1f} мс  max {stats['max_ms']:8.1f} мс", file=sys.stderr)
+    failures = data['failures']
+    if failures['timeouts'] or failures['bot_errors']:
+        print(f"⚠️ Таймауты: {failures['timeouts']}, ошибки бота: {failures['bot_errors']} "
+              f"(лог бота: {data['bot_log']})", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест воронки с заглушкой Bot API")
+    parser.add_argument('--users', type=int, default=1000, help="число пользователей")
+    parser.add_argument('--rate', type=float, default=50, help="новых пользователей в секунду")
+    parser.add_argument('--think-time', type=float, default=1.0,
+                        help="средняя пауза перед нажатием «Далее», секунды")
+    parser.add_argument('--timeout', type=float, default=60, help="сколько ждать ответа бота, секунды")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответов заглушки, секунды")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, секунды")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429")
+    parser.add_argument('--error-methods', default=DEFAULT_ERROR_METHODS,
+                        help="методы, которые могут ответить 429")
+    parser.add_argument('--first-user-id', type=int, default=10_000_000)
+    parser.add_argument('--port', type=int, default=0, help="порт заглушки (0 — любой свободный)")
+    parser.add_argument('--token', default='123456:LOADTEST')
+    parser.add_argument('--bot-env', action='append', default=[], metavar='KEY=VALUE',
+                        help="переменная окружения для бота (можно повторять)")
+    parser.add_argument('--no-bot', action='store_true', help="не запускать бота, только заглушку и нагрузку")
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--output', help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    data = report(args, asyncio.run(run(args)))
+    print_summary(data)
+    output = json.dumps(data, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output, encoding='utf-8')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
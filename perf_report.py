@@ -0,0 +1,47 @@
+import platform
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+
+def summarize(samples):
+    """Статистика по замерам (секунды) в миллисекундах"""
+    samples = sorted(samples)
+    count = len(samples)
+
+    def percentile(p):
+        return samples[min(count - 1, int(p * count))] * 1000
+
+    return {
+        'n': count,
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': statistics.median(samples) * 1000,
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'min_ms': samples[0] * 1000,
+        'max_ms': samples[-1] * 1000,
+        'ops_per_sec': count / sum(samples) if sum(samples) else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_info():
+    """Общие поля отчетов benchmark.py и loadtest.py: коммит, время, окружение"""
+    return {
+        'commit': git_commit(),
+        'created_at': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class Prerenderer:
+    """Фоновая подготовка следующего этапа, пока пользователь читает текущий
+
+    На каждого пользователя — не больше одной задачи: новая заменяет старую.
+    Бюджет CPU — число одновременных рендеров (concurrency), остальные мощности
+    пула остаются интерактивным отправкам. Бюджет памяти — суммарный размер
+    подготовленных, но еще не отправленных изображений (max_bytes): сверх него
+    задачи отбрасываются (превысить его могут только рендеры, уже идущие в
+    этот момент). Изображения, которые не понадобились за ttl секунд
+    (пользователь ушел), перестают занимать бюджет.
+
+    Из кэша изображения не удаляются: ключ зависит только от этапа и имени,
+    так что то же изображение может понадобиться другому пользователю (или
+    воркеру с общим каталогом кэша) — вытеснять его будет LRU кэша.
+    """
+
+    def __init__(self, render, concurrency=1, max_pending=1000,
+                 max_bytes=16 * 1024 * 1024, ttl=600.0):
+        # render(stage, user_name) -> корутина, возвращающая (ключ кэша, размер) или None
+        self.render = render
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # telegram_id -> (этап, имя) в порядке постановки
+        self._pending = OrderedDict()
+        # telegram_id -> (ключ кэша, размер, время подготовки)
+        self._ready = OrderedDict()
+        self._bytes = 0
+        self._wakeup = asyncio.Event()
+
+    @classmethod
+    def from_env(cls, render):
+        """Создает очередь по переменным PRERENDER_*; None, если PRERENDER_CONCURRENCY=0"""
+        concurrency = int(os.getenv("PRERENDER_CONCURRENCY", "1"))
+        if concurrency <= 0:
+            return None
+        return cls(
+            render,
+            concurrency=concurrency,
+            max_pending=int(os.getenv("PRERENDER_QUEUE_SIZE", "1000")),
+            max_bytes=int(float(os.getenv("PRERENDER_MEMORY_MB", "16")) * 1024 * 1024),
+            ttl=float(os.getenv("PRERENDER_TTL", "600")),
+        )
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @property
+    def ready_bytes(self):
+        return self._bytes
+
+    def schedule(self, telegram_id, stage, user_name):
+        """Пользователь получил этап stage - 1: готовим для него этап stage"""
+        telegram_id = str(telegram_id)
+        # Подготовленное ранее изображение уже отправлено или больше не нужно
+        self._release(telegram_id)
+        self._pending.pop(telegram_id, None)
+        if self._bytes >= self.max_bytes:
+            log.debug("Предрендер пропущен: бюджет памяти исчерпан", extra={'user_id': telegram_id})
+            return False
+        self._pending[telegram_id] = (stage, user_name)
+        # Очередь ограничена: самые старые задачи менее актуальны
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+        self._wakeup.set()
+        return True
+
+    def cancel(self, telegram_id):
+        """Пользователь выбыл (заблокировал бота, закончил воронку): задача больше не нужна"""
+        telegram_id = str(telegram_id)
+        self._pending.pop(telegram_id, None)
+        self._release(telegram_id)
+
+    async def run(self):
+        """Рендерит задачи очереди в concurrency потоков и освобождает бюджет просроченных изображений"""
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            while True:
+                await asyncio.sleep(min(self.ttl, 60.0))
+                self._expire(time.time())
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _worker(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            telegram_id, (stage, user_name) = self._pending.popitem(last=False)
+            if self._bytes >= self.max_bytes:
+                continue
+            try:
+                result = await self.render(stage, user_name)
+            except Exception as e:
+                log.warning("⚠️ Предрендер этапа %s не удался: %s", stage, e, extra={'user_id': telegram_id})
+                continue
+            # Пока шел рендер, пользователь мог получить новую задачу — тогда результат не храним
+            if result is None or telegram_id in self._pending or telegram_id in self._ready:
+                continue
+            key, size = result
+            self._ready[telegram_id] = (key, size, time.time())
+            self._bytes += size
+
+    def _release(self, telegram_id):
+        entry = self._ready.pop(telegram_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+        return entry
+
+    def _expire(self, now):
+        while self._ready:
+            telegram_id, (_, _, prepared_at) = next(iter(self._ready.items()))
+            if now - prepared_at < self.ttl:
+                break
+            self._release(telegram_id)
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+class RenderCache:
+    """LRU-кэш закодированных изображений этапов и их Telegram file_id
+
+    Без каталога изображения хранятся в памяти (ограничение по байтам),
+    с каталогом — на диске (ограничение по числу файлов) и переживают перезапуск.
+    С каталогом file_id тоже пишутся на диск (подкаталог file_ids), поэтому
+    процессы с общим каталогом не загружают одно изображение каждый сам.
+    """
+
+    def __init__(self, directory=None, max_files=1000, max_memory_bytes=64 * 1024 * 1024,
+                 max_file_ids=100000):
+        self.directory = Path(directory) if directory else None
+        self.max_files = max_files
+        self.max_memory_bytes = max_memory_bytes
+        self.max_file_ids = max_file_ids
+        # key -> bytes (в памяти) или Path (на диске)
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._file_ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.file_id_dir = self.directory / 'file_ids' if self.directory is not None else None
+
+        if self.directory is not None:
+            self.file_id_dir.mkdir(parents=True, exist_ok=True)
+            # Восстанавливаем порядок LRU по времени изменения файлов
+            existing = sorted(
+                (p for p in self.directory.iterdir() if p.is_file() and p.suffix != '.tmp'),
+                key=lambda p: p.stat().st_mtime
+            )
+            for path in existing:
+                self._entries[path.stem] = path
+            self._evict()
+
+    @staticmethod
+    def make_key(stage, user_name, template_version):
+        """Ключ кэша: хэш от этапа, имени и версии шаблона"""
+        raw = f"{stage}\0{user_name}\0{template_version}".encode('utf-8')
+        return f"stage{stage}_{hashlib.sha256(raw).hexdigest()[:32]}"
+
+    @classmethod
+    def from_env(cls):
+        """Создает кэш по переменным окружения RENDER_CACHE_*"""
+        return cls(
+            os.getenv("RENDER_CACHE_DIR") or None,
+            max_files=int(os.getenv("RENDER_CACHE_SIZE", "1000")),
+            max_memory_bytes=int(float(os.getenv("RENDER_CACHE_MEMORY_MB", "64")) * 1024 * 1024),
+        )
+
+    def get(self, key, extension=None):
+        """Возвращает закодированное изображение или None
+
+        С extension на диске ищется и файл, записанный другим процессом
+        (общий каталог кэша у нескольких воркеров).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if self.directory is None or extension is None:
+                    return None
+                entry = self.directory / f"{key}.{extension}"
+                if not entry.exists():
+                    return None
+                self._entries[key] = entry
+                self._evict()
+            self._entries.move_to_end(key)
+        if isinstance(entry, bytes):
+            return entry
+        try:
+            return entry.read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+
+    def put(self, key, data, extension='bin'):
+        """Сохраняет закодированное изображение"""
+        if self.directory is None:
+            entry = data
+        else:
+            entry = self.directory / f"{key}.{extension}"
+            # Пишем во временный файл и атомарно переименовываем
+            tmp_path = self.directory / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, entry)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if isinstance(previous, bytes):
+                self._memory_bytes -= len(previous)
+            self._entries[key] = entry
+            if isinstance(entry, bytes):
+                self._memory_bytes += len(entry)
+            self._evict()
+
+    def contains(self, key):
+        """Есть ли изображение в кэше (без чтения и без обновления LRU)"""
+        with self._lock:
+            return key in self._entries
+
+    def get_file_id(self, key):
+        """Возвращает file_id уже загруженного в Telegram изображения
+
+        Если его нет в памяти, ищется file_id, записанный другим процессом.
+        """
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+                return file_id
+        if self.file_id_dir is None:
+            return None
+        try:
+            file_id = (self.file_id_dir / key).read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        self._remember_file_id(key, file_id)
+        return file_id
+
+    def set_file_id(self, key, file_id):
+        """Запоминает file_id после первой загрузки"""
+        if self.file_id_dir is not None:
+            tmp_path = self.file_id_dir / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+            tmp_path.write_text(file_id, encoding='utf-8')
+            os.replace(tmp_path, self.file_id_dir / key)
+        self._remember_file_id(key, file_id)
+
+    def forget_file_id(self, key):
+        """Удаляет file_id, который Telegram больше не принимает"""
+        with self._lock:
+            self._file_ids.pop(key, None)
+        self._unlink_file_id(key)
+
+    def _remember_file_id(self, key, file_id):
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            evicted = []
+            while len(self._file_ids) > self.max_file_ids:
+                evicted.append(self._file_ids.popitem(last=False)[0])
+        for old_key in evicted:
+            self._unlink_file_id(old_key)
+
+    def _unlink_file_id(self, key):
+        if self.file_id_dir is None:
+            return
+        try:
+            (self.file_id_dir / key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        # Вызывается под блокировкой
+        while self._entries and (
+            len(self._entries) > self.max_files or self._memory_bytes > self.max_memory_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            if isinstance(entry, bytes):
+                self._memory_bytes -= len(entry)
+                continue
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from broadcast import RateLimiter, retry_after_seconds
+
+# Приоритеты: ответы на действия пользователя обгоняют рассылки и автоотправку
+INTERACTIVE = 0
+BULK = 1
+
+log = logging.getLogger(__name__)
+
+
+class _Request:
+    """Запрос в очереди; seq сохраняет порядок постановки при повторах"""
+
+    __slots__ = ('seq', 'priority', 'chat_id', 'call', 'future', 'attempts', 'floods')
+
+    def __init__(self, seq, priority, chat_id, call, future):
+        self.seq = seq
+        self.priority = priority
+        self.chat_id = chat_id
+        self.call = call
+        self.future = future
+        self.attempts = 0
+        self.floods = 0
+
+
+class SendQueue:
+    """Очередь исходящих запросов к Telegram с учетом лимитов
+
+    Один диспетчер выдает запросы не чаще rate в секунду на бота и не чаще
+    одного за chat_interval секунд в чат; из готовых первым уходит запрос с
+    меньшим priority. RetryAfter ставит на паузу всю очередь и повторяет
+    запрос после паузы до max_flood_retries раз, сетевые ошибки повторяются
+    с растущей задержкой до max_retries раз. Когда повторы кончились, ошибка
+    (в том числе RetryAfter) возвращается вызывающему, как и BadRequest и
+    Forbidden.
+
+    Повтор после таймаута может продублировать сообщение, если Telegram
+    успел его принять: для воронки это лучше, чем ошибка пользователю.
+    """
+
+    def __init__(self, rate=30.0, chat_interval=1.0, concurrency=32, max_retries=3,
+                 max_flood_retries=5, backoff=0.5, on_retry=None):
+        self.limiter = RateLimiter(rate)
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.max_flood_retries = max_flood_retries
+        self.backoff = backoff
+        # on_retry(reason, delay) — для метрик; reason: 'flood' или 'network'
+        self.on_retry = on_retry
+        self._slots = asyncio.Semaphore(concurrency)
+        # Куча (priority, seq, запрос), готовых к отправке
+        self._ready = []
+        self._seq = itertools.count()
+        # chat_id -> время (monotonic), раньше которого в чат не отправляем
+        self._chat_next = {}
+        # Отложенные запросы (лимит чата, повтор) -> таймер возврата в очередь
+        self._deferred = {}
+        # Задача отправки -> ее запрос
+        self._inflight = {}
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    @classmethod
+    def from_env(cls, on_retry=None):
+        """Создает очередь по переменным SEND_*
+
+        Лимит Telegram общий на бота: по умолчанию он делится между WORKER_COUNT
+        воркерами многопроцессного режима.
+        """
+        workers = max(1, int(os.getenv("WORKER_COUNT", "1")))
+        return cls(
+            rate=float(os.getenv("SEND_RATE", str(30 / workers))),
+            chat_interval=float(os.getenv("SEND_CHAT_INTERVAL", "1")),
+            concurrency=int(os.getenv("SEND_CONCURRENCY", "32")),
+            max_retries=int(os.getenv("SEND_RETRIES", "3")),
+            max_flood_retries=int(os.getenv("SEND_FLOOD_RETRIES", "5")),
+            on_retry=on_retry,
+        )
+
+    @property
+    def pending(self):
+        return len(self._ready) + len(self._deferred)
+
+    def start(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        """Останавливает диспетчер; неотправленные запросы отменяются"""
+        if self._dispatcher is None:
+            return
+        self._dispatcher.cancel()
+        tasks = list(self._inflight)
+        for task, request in self._inflight.items():
+            # Задача, отмененная до старта, сама запрос не завершит
+            task.cancel()
+            request.future.cancel()
+        await asyncio.gather(self._dispatcher, *tasks, return_exceptions=True)
+        self._dispatcher = None
+        for request, timer in self._deferred.items():
+            timer.cancel()
+            request.future.cancel()
+        for _, _, request in self._ready:
+            request.future.cancel()
+        self._deferred.clear()
+        self._ready.clear()
+
+    async def send(self, chat_id, call, priority=INTERACTIVE):
+        """Выполняет call() (корутину запроса к Bot API) в очереди и возвращает ее результат
+
+        call вызывается заново при каждом повторе, поэтому это функция без
+        аргументов (например, functools.partial), а не готовая корутина.
+        Без запущенного диспетчера (скрипты, отладка) запрос выполняется сразу.
+        """
+        if self._dispatcher is None:
+            return await call()
+        future = asyncio.get_running_loop().create_future()
+        self._push(_Request(next(self._seq), priority, chat_id, call, future))
+        return await future
+
+    def _push(self, request):
+        heapq.heappush(self._ready, (request.priority, request.seq, request))
+        self._wakeup.set()
+
+    def _defer(self, request, delay):
+        timer = asyncio.get_running_loop().call_later(delay, self._requeue, request)
+        self._deferred[request] = timer
+
+    def _requeue(self, request):
+        del self._deferred[request]
+        self._push(request)
+
+    async def _dispatch(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self._slots.acquire()
+            # Слот берется до выбора запроса: после паузы уйдет самый приоритетный
+            await self.limiter.acquire()
+            request = self._pop_ready()
+            if request is None:
+                # Все готовые запросы упали в лимит своих чатов и отложены
+                self.limiter.refund()
+                self._slots.release()
+                continue
+            task = asyncio.create_task(self._attempt(request))
+            self._inflight[task] = request
+            task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        del self._inflight[task]
+
+    def _pop_ready(self):
+        """Первый по приоритету запрос, чат которого свободен; занятые чаты откладываются"""
+        now = time.monotonic()
+        while self._ready:
+            _, _, request = heapq.heappop(self._ready)
+            # Вызывающий перестал ждать (отмена обработчика)
+            if request.future.done():
+                continue
+            if request.chat_id is None:
+                return request
+            ready_at = self._chat_next.get(request.chat_id, 0.0)
+            if ready_at > now:
+                self._defer(request, ready_at - now)
+                continue
+            self._chat_next[request.chat_id] = now + self.chat_interval
+            # Старые отметки больше не ограничивают отправку
+            if len(self._chat_next) > 10000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+            return request
+        return None
+
+    async def _attempt(self, request):
+        try:
+            result = await request.call()
+        except RetryAfter as e:
+            # Flood control общий для бота: пауза и снижение темпа для всей очереди
+            delay = retry_after_seconds(e)
+            self.limiter.penalize(delay)
+            log.warning("⚠️ Flood control: пауза отправок %.1f с", delay)
+            if request.floods >= self.max_flood_retries:
+                self._fail(request, e)
+            else:
+                request.floods += 1
+                self._retry(request, 'flood', delay)
+        except BadRequest as e:
+            # BadRequest — подкласс NetworkError, но повтор его не исправит
+            self._fail(request, e)
+        except NetworkError as e:
+            if request.attempts >= self.max_retries:
+                self._fail(request, e)
+            else:
+                delay = self.backoff * 2 ** request.attempts
+                request.attempts += 1
+                log.warning("⚠️ Сетевая ошибка отправки, повтор через %.1f с: %s", delay, e)
+                self._retry(request, 'network', delay)
+        except Exception as e:
+            self._fail(request, e)
+        else:
+            self.limiter.reward()
+            if not request.future.done():
+                request.future.set_result(result)
+        finally:
+            self._slots.release()
+
+    def _retry(self, request, reason, delay):
+        if request.future.done():
+            return
+        if self.on_retry is not None:
+            self.on_retry(reason, delay)
+        self._defer(request, delay)
+
+    @staticmethod
+    def _fail(request, error):
+        if not request.future.done():
+            request.future.set_exception(error)
@@ -0,0 +1,35 @@
+import asyncio
+
+
+class SingleFlight:
+    """Объединяет одновременные вызовы с одинаковым ключом в одно выполнение
+
+    Первый вызов запускает работу, остальные ждут ее результат (или ошибку).
+    Отмена одного из ожидающих не отменяет общую работу.
+    """
+
+    def __init__(self):
+        # ключ -> задача, выполняющаяся сейчас
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    async def run(self, key, func, *args):
+        """Возвращает результат func(*args); повторные ключи ждут уже запущенный вызов"""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Ошибку могли не забрать, если все ожидающие были отменены
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,714 @@
+import io
+import math
+import re
+from functools import lru_cache
+from html.parser import HTMLParser
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+# Размер итогового изображения
+CANVAS_SIZE = (1080, 1080)
+
+# Подстановка, которая отличает персональные строки от статичных
+NAME_PLACEHOLDER = "{{name}}"
+
+BLOCK_TAGS = {'body', 'div', 'p', 'section', 'header', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li'}
+IGNORED_TAGS = {'head', 'title', 'script', 'style', 'meta', 'link'}
+VOID_TAGS = {'br', 'meta', 'link', 'img', 'hr', 'input'}
+INHERITED = {'color', 'font-size', 'font-weight', 'font-family', 'line-height'}
+
+# Стили браузера по умолчанию, которые встречаются в шаблонах
+TAG_DEFAULTS = {
+    'body': {'font-size': '16px', 'color': '#000000', 'font-weight': '400', 'line-height': 'normal',
+             'font-family': 'sans-serif'},
+    'h1': {'font-size': '2em', 'font-weight': '700'},
+    'h2': {'font-size': '1.5em', 'font-weight': '700'},
+    'h3': {'font-size': '1.17em', 'font-weight': '700'},
+    'strong': {'font-weight': '700'},
+    'b': {'font-weight': '700'},
+}
+
+NAMED_COLORS = {
+    'white': (255, 255, 255), 'black': (0, 0, 0), 'red': (255, 0, 0), 'green': (0, 128, 0),
+    'blue': (0, 0, 255), 'yellow': (255, 255, 0), 'orange': (255, 165, 0), 'gray': (128, 128, 128),
+    'grey': (128, 128, 128), 'transparent': (0, 0, 0, 0),
+}
+
+# Файлы шрифтов для семейств из font-family: (обычный, жирный)
+FONT_FAMILY_FILES = {
+    'arial': ('arial.ttf', 'arialbd.ttf'),
+    'helvetica': ('arial.ttf', 'arialbd.ttf'),
+    'liberation sans': ('LiberationSans-Regular.ttf', 'LiberationSans-Bold.ttf'),
+    'dejavu sans': ('DejaVuSans.ttf', 'DejaVuSans-Bold.ttf'),
+    'sans-serif': ('DejaVuSans.ttf', 'DejaVuSans-Bold.ttf'),
+}
+
+
+class TemplateError(ValueError):
+    """Шаблон не удалось разобрать"""
+
+
+class _Element:
+    def __init__(self, tag, attrs=None):
+        self.tag = tag
+        self.attrs = attrs or {}
+        self.classes = set((self.attrs.get('class') or '').split())
+        self.children = []
+        self.style = {}
+
+
+class _DomBuilder(HTMLParser):
+    """Строит упрощенное DOM-дерево и собирает CSS из <style>"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = _Element('#root')
+        self.stack = [self.root]
+        self.css = []
+
+    def handle_starttag(self, tag, attrs):
+        element = _Element(tag, dict(attrs))
+        self.stack[-1].children.append(element)
+        if tag not in VOID_TAGS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.stack[-1].children.append(_Element(tag, dict(attrs)))
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].tag == tag:
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data):
+        current = self.stack[-1]
+        if current.tag == 'style':
+            self.css.append(data)
+        elif not any(el.tag in IGNORED_TAGS for el in self.stack):
+            current.children.append(data)
+
+
+# ---------- CSS ----------
+
+def _parse_declarations(text):
+    declarations = {}
+    for part in text.split(';'):
+        if ':' not in part:
+            continue
+        prop, value = part.split(':', 1)
+        prop, value = prop.strip().lower(), value.strip()
+        if prop in ('margin', 'padding'):
+            # Раскрываем сокращенную запись 1-4 значениями
+            values = value.split()
+            if not values:
+                continue
+            top = values[0]
+            right = values[1] if len(values) > 1 else top
+            bottom = values[2] if len(values) > 2 else top
+            left = values[3] if len(values) > 3 else right
+            declarations.update({
+                f'{prop}-top': top, f'{prop}-right': right,
+                f'{prop}-bottom': bottom, f'{prop}-left': left,
+            })
+        elif prop == 'background-color':
+            declarations['background'] = value
+        else:
+            declarations[prop] = value
+    return declarations
+
+
+def _parse_css(css):
+    """Возвращает правила [(специфичность, порядок, селектор, объявления)]"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    rules = []
+    for order, match in enumerate(re.finditer(r'([^{}]+)\{([^{}]*)\}', css)):
+        declarations = _parse_declarations(match.group(2))
+        for selector in match.group(1).split(','):
+            selector = selector.strip()
+            # Поддерживаются только простые селекторы: *, tag, .class, tag.class
+            parsed = re.fullmatch(r'(\*|[a-z][a-z0-9]*)?((?:\.[\w-]+)*)', selector, flags=re.I)
+            if not selector or parsed is None:
+                continue
+            tag = parsed.group(1)
+            classes = set(filter(None, parsed.group(2).split('.')))
+            specificity = (len(classes), 1 if tag and tag != '*' else 0)
+            rules.append((specificity, order, (tag, classes), declarations))
+    rules.sort(key=lambda rule: (rule[0], rule[1]))
+    return rules
+
+
+def _compute_styles(element, rules, parent_style):
+    style = {prop: parent_style[prop] for prop in INHERITED if prop in parent_style}
+    style.update(TAG_DEFAULTS.get(element.tag, {}))
+    for _, _, (tag, classes), declarations in rules:
+        if tag not in (None, '*', element.tag) or not classes <= element.classes:
+            continue
+        style.update(declarations)
+    style.update(_parse_declarations(element.attrs.get('style') or ''))
+    style['_font_px'] = _length(style.get('font-size', '16px'), parent_style.get('_font_px', 16.0))
+    # Наследуется уже вычисленный размер, а не относительная запись
+    style['font-size'] = f"{style['_font_px']}px"
+    element.style = style
+    for child in element.children:
+        if isinstance(child, _Element):
+            _compute_styles(child, rules, style)
+
+
+def _length(value, font_px=16.0, default=0.0):
+    """Переводит CSS длину в пиксели (px, em, %, число)"""
+    if value is None:
+        return default
+    value = str(value).strip().split()[0] if str(value).strip() else ''
+    try:
+        if value.endswith('px'):
+            return float(value[:-2])
+        if value.endswith('em'):
+            return float(value[:-2].rstrip('r')) * font_px
+        if value.endswith('%'):
+            return float(value[:-1]) / 100 * font_px
+        return float(value)
+    except ValueError:
+        return default
+
+
+def _split_args(text):
+    """Делит аргументы CSS функции по запятым верхнего уровня"""
+    args, depth, current = [], 0, ''
+    for char in text:
+        if char == ',' and depth == 0:
+            args.append(current.strip())
+            current = ''
+            continue
+        depth += char == '('
+        depth -= char == ')'
+        current += char
+    if current.strip():
+        args.append(current.strip())
+    return args
+
+
+def parse_color(value):
+    """Цвет CSS в кортеж RGBA"""
+    value = value.strip().lower()
+    if value in NAMED_COLORS:
+        color = NAMED_COLORS[value]
+        return color if len(color) == 4 else color + (255,)
+    if value.startswith('#'):
+        hex_color = value[1:]
+        if len(hex_color) == 3:
+            hex_color = ''.join(c * 2 for c in hex_color)
+        return tuple(int(hex_color[i:i + 2], 16) for i in (0, 2, 4)) + (255,)
+    match = re.fullmatch(r'rgba?\((.*)\)', value)
+    if match:
+        parts = [p.strip() for p in match.group(1).split(',')]
+        rgb = tuple(int(float(p)) for p in parts[:3])
+        alpha = int(round(float(parts[3]) * 255)) if len(parts) > 3 else 255
+        return rgb + (alpha,)
+    raise TemplateError(f"Unsupported color: {value}")
+
+
+def _parse_background(value):
+    """Фон: ('color', rgba) или ('gradient', угол, [(позиция, rgba)])"""
+    if not value:
+        return None
+    value = value.strip()
+    if value in ('none', 'transparent'):
+        return None
+    match = re.match(r'linear-gradient\((.*)\)\s*$', value, flags=re.S)
+    if match is None:
+        color = parse_color(value.split()[0] if not value.startswith('rgb') else value)
+        return ('color', color) if color[3] else None
+    args = _split_args(match.group(1))
+    angle = 180.0
+    directions = {'to top': 0.0, 'to right': 90.0, 'to bottom': 180.0, 'to left': 270.0}
+    if args and args[0].endswith('deg'):
+        angle = float(args.pop(0)[:-3])
+    elif args and args[0] in directions:
+        angle = directions[args.pop(0)]
+    stops = []
+    for arg in args:
+        position = None
+        color_part = arg
+        stop = re.match(r'(.*?)\s+([\d.]+)%$', arg)
+        if stop:
+            color_part, position = stop.group(1), float(stop.group(2)) / 100
+        stops.append([position, parse_color(color_part)])
+    if len(stops) < 2:
+        raise TemplateError(f"Gradient needs at least two colors: {value}")
+    # Стопы без позиции распределяем равномерно
+    for i, stop in enumerate(stops):
+        if stop[0] is None:
+            stop[0] = i / (len(stops) - 1)
+    return ('gradient', angle, [tuple(stop) for stop in stops])
+
+
+def _parse_border(value):
+    if not value:
+        return 0, None
+    width, color = 0, None
+    for part in re.findall(r'rgba?\([^)]*\)|\S+', value):
+        if part.endswith('px'):
+            width = _length(part)
+        elif part not in ('solid', 'none'):
+            try:
+                color = parse_color(part)
+            except TemplateError:
+                pass
+    return (width, color) if color else (0, None)
+
+
+# ---------- Шрифты и градиенты ----------
+
+@lru_cache(maxsize=None)
+def _font_path(family, bold):
+    """Первый доступный файл шрифта для списка font-family"""
+    names = [name.strip().strip('\'"').lower() for name in family.split(',')]
+    candidates = []
+    for name in names + ['arial', 'sans-serif']:
+        files = FONT_FAMILY_FILES.get(name)
+        if files:
+            candidates.extend([files[1], files[0]] if bold else [files[0]])
+    for path in candidates:
+        try:
+            ImageFont.truetype(path, 10)
+            return path
+        except OSError:
+            continue
+    return None
+
+
+def font_file(family, bold):
+    """Путь к файлу шрифта для font-family или None (встроенный шрифт Pillow)"""
+    return _font_path(family, bool(bold))
+
+
+# Шрифты из пакета ресурсов: (font-family, жирный) -> содержимое файла шрифта
+_font_data = {}
+
+
+def register_font(family, bold, data):
+    """Подменяет поиск файла шрифта готовыми данными (пакет ресурсов)"""
+    _font_data[(family, bool(bold))] = data
+    get_font.cache_clear()
+
+
+@lru_cache(maxsize=256)
+def get_font(family, bold, size):
+    """Загружает шрифт один раз на процесс"""
+    size = max(int(size), 1)
+    data = _font_data.get((family, bool(bold)))
+    if data is not None:
+        return ImageFont.truetype(io.BytesIO(data), size)
+    path = _font_path(family, bold)
+    if path is not None:
+        return ImageFont.truetype(path, size)
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow < 10.1 не умеет масштабировать встроенный шрифт
+        return ImageFont.load_default()
+
+
+def gradient_image(size, angle, stops):
+    """Строит CSS linear-gradient заданного размера без попиксельного цикла"""
+    width, height = size
+    rad = math.radians(angle)
+    dx, dy = math.sin(rad), -math.cos(rad)
+    length = abs(width * dx) + abs(height * dy)
+    weight_x = abs(width * dx) / length
+    weight_y = abs(height * dy) / length
+
+    # Линейные рампы 0..255 по осям, развернутые по направлению градиента
+    ramp = Image.linear_gradient('L')
+    ramp_y = ramp.resize(size, Image.BILINEAR)
+    ramp_x = ramp.transpose(Image.TRANSPOSE).resize(size, Image.BILINEAR)
+    if dx < 0:
+        ramp_x = ramp_x.transpose(Image.FLIP_LEFT_RIGHT)
+    # Ось y на изображении направлена вниз, а 0deg в CSS — вверх
+    if dy < 0:
+        ramp_y = ramp_y.transpose(Image.FLIP_TOP_BOTTOM)
+    t = ImageChops.add(
+        ramp_x.point(lambda p: p * weight_x),
+        ramp_y.point(lambda p: p * weight_y)
+    )
+
+    # Таблицы цвета для каждого из 256 значений t
+    channels = ([], [], [])
+    for i in range(256):
+        color = _color_at(stops, i / 255)
+        for channel, value in zip(channels, color):
+            channel.append(value)
+    return Image.merge('RGB', [t.point(channel) for channel in channels])
+
+
+def _color_at(stops, t):
+    if t <= stops[0][0]:
+        return stops[0][1][:3]
+    for (pos1, color1), (pos2, color2) in zip(stops, stops[1:]):
+        if t <= pos2:
+            local = (t - pos1) / (pos2 - pos1) if pos2 > pos1 else 1.0
+            return tuple(int(c1 + (c2 - c1) * local) for c1, c2 in zip(color1[:3], color2[:3]))
+    return stops[-1][1][:3]
+
+
+# ---------- Раскладка ----------
+
+class _Line:
+    """Строка текста: сегменты (текст, стиль) и отступы gap"""
+
+    def __init__(self):
+        self.segments = []
+
+    def add_text(self, text, style):
+        if self.segments and isinstance(self.segments[-1], tuple) and self.segments[-1][1] is style:
+            self.segments[-1] = (self.segments[-1][0] + text, style)
+        else:
+            self.segments.append((text, style))
+
+    def add_gap(self, px):
+        self.segments.append(px)
+
+    def normalize(self):
+        """Схлопывает пробелы как в браузере и убирает пустые сегменты"""
+        result = []
+        previous_space = True
+        for segment in self.segments:
+            if isinstance(segment, tuple):
+                text = re.sub(r'\s+', ' ', segment[0])
+                if previous_space:
+                    text = text.lstrip(' ')
+                if not text:
+                    continue
+                previous_space = text.endswith(' ')
+                result.append((text, segment[1]))
+            else:
+                if result and isinstance(result[-1], tuple):
+                    result[-1] = (result[-1][0].rstrip(' '), result[-1][1])
+                result.append(segment)
+                previous_space = True
+        # Убираем хвостовые пробелы и крайние отступы
+        while result and not isinstance(result[-1], tuple):
+            result.pop()
+        while result and not isinstance(result[0], tuple):
+            result.pop(0)
+        if result:
+            result[-1] = (result[-1][0].rstrip(' '), result[-1][1])
+        self.segments = [s for s in result if not isinstance(s, tuple) or s[0]]
+        return self
+
+
+def _is_block(node):
+    return isinstance(node, _Element) and node.tag in BLOCK_TAGS
+
+
+def _collect_inline(element, lines, flex_gap=None):
+    """Собирает строчное содержимое элемента в строки, <br> начинает новую строку"""
+    first = True
+    for child in element.children:
+        if flex_gap is not None:
+            # Элементы flex-строки разделяются gap, пробелы между ними не учитываются
+            if isinstance(child, str) and not child.strip():
+                continue
+            if not first:
+                lines[-1].add_gap(flex_gap)
+            first = False
+        if isinstance(child, str):
+            lines[-1].add_text(child.strip() if flex_gap is not None else child, element.style)
+        elif child.tag == 'br':
+            lines.append(_Line())
+        elif child.tag not in IGNORED_TAGS:
+            _collect_inline(child, lines)
+    return lines
+
+
+def _is_flex_row(style):
+    return style.get('display') == 'flex' and style.get('flex-direction', 'row') == 'row'
+
+
+class _Box:
+    def __init__(self, style, scale):
+        font_px = style['_font_px']
+        self.margin_top = _length(style.get('margin-top'), font_px) * scale
+        self.margin_bottom = _length(style.get('margin-bottom'), font_px) * scale
+        self.padding = [
+            _length(style.get(f'padding-{side}'), font_px) * scale
+            for side in ('top', 'right', 'bottom', 'left')
+        ]
+        border_width, self.border_color = _parse_border(style.get('border'))
+        self.border = border_width * scale
+        self.radius = _length(style.get('border-radius'), font_px) * scale
+        self.background = _parse_background(style.get('background'))
+        self.gap = _length(style.get('gap'), font_px) * scale
+
+
+class _Layout:
+    """Раскладывает дерево в операции отрисовки при заданном масштабе"""
+
+    def __init__(self, width, scale):
+        self.width = width
+        self.scale = scale
+        self.ops = []
+        self.required_width = 0.0
+
+    def block(self, element, y, box_width, depth_inset):
+        """Раскладывает блок, возвращает его высоту (без внешних отступов)"""
+        box = _Box(element.style, self.scale)
+        x0 = (self.width - box_width) / 2
+        box_index = len(self.ops)
+        if box.background or box.border:
+            self.ops.append(None)  # место под фон, размеры станут известны позже
+        inset = box.border + max(box.padding[1], box.padding[3])
+        content_y = y + box.border + box.padding[0]
+        content_width = box_width - 2 * inset
+
+        if any(_is_block(child) for child in element.children):
+            height = self._stack(element, content_y, content_width, depth_inset + inset, box.gap)
+        else:
+            height = self._text(element, content_y, content_width, depth_inset + inset)
+
+        total = height + box.padding[0] + box.padding[2] + 2 * box.border
+        if box.background or box.border:
+            self.ops[box_index] = ('box', (x0, y, x0 + box_width, y + total), box)
+        return total
+
+    def _stack(self, element, y, width, depth_inset, gap):
+        """Вертикальная раскладка дочерних блоков со схлопыванием margin"""
+        start = y
+        previous_margin = None
+        for child in element.children:
+            if isinstance(child, str) or not _is_block(child):
+                # Строчные элементы между блоками оборачиваем в анонимный блок
+                wrapper = _Element('div')
+                wrapper.children = [child]
+                wrapper.style = {k: v for k, v in element.style.items() if k in INHERITED or k == '_font_px'}
+                if not self._has_text(wrapper):
+                    continue
+                child = wrapper
+            box = _Box(child.style, self.scale)
+            if previous_margin is None:
+                y += box.margin_top
+            else:
+                y += max(previous_margin, box.margin_top) + gap
+            y += self.block(child, y, width, depth_inset)
+            previous_margin = box.margin_bottom
+        if previous_margin is not None:
+            y += previous_margin
+        return y - start
+
+    def _has_text(self, element):
+        for child in element.children:
+            if isinstance(child, str):
+                if child.strip():
+                    return True
+            elif child.tag == 'br' or self._has_text(child):
+                return True
+        return False
+
+    def _text(self, element, y, width, depth_inset):
+        """Строки текста блока, каждая по центру"""
+        style = element.style
+        flex_gap = None
+        if _is_flex_row(style):
+            flex_gap = _length(style.get('gap'), style['_font_px'])
+        lines = [line.normalize() for line in _collect_inline(element, [_Line()], flex_gap)]
+        start = y
+        for line in lines:
+            if not line.segments:
+                # Пустая строка (<br><br>) занимает высоту шрифта блока
+                y += self._line_height(style)
+                continue
+            runs = []
+            for segment in line.segments:
+                if isinstance(segment, tuple):
+                    text, run_style = segment
+                    runs.append(('text', text, _font_key(run_style, self.scale), parse_color(run_style.get('color', '#000'))[:3]))
+                else:
+                    runs.append(('gap', segment * self.scale))
+            line_height = max(self._line_height(seg[1]) for seg in line.segments if isinstance(seg, tuple))
+            largest = get_font(*max((run[2] for run in runs if run[0] == 'text'), key=lambda key: key[2]))
+            ascent, descent = largest.getmetrics()
+            baseline = y + (line_height - (ascent + descent)) / 2 + ascent
+            line_width = _measure(runs)
+            self.required_width = max(self.required_width, line_width + 2 * depth_inset)
+            dynamic = any(run[0] == 'text' and NAME_PLACEHOLDER in run[1] for run in runs)
+            self.ops.append(('line', runs, baseline, width, dynamic))
+            y += line_height
+        return y - start
+
+    def _line_height(self, style):
+        font_px = style['_font_px'] * self.scale
+        value = str(style.get('line-height', 'normal')).strip()
+        if value == 'normal':
+            return font_px * 1.2
+        if value.endswith(('px', 'em', '%')):
+            return _length(value, style['_font_px']) * self.scale
+        try:
+            return font_px * float(value)
+        except ValueError:
+            return font_px * 1.2
+
+
+def _font_key(style, scale):
+    weight = str(style.get('font-weight', '400')).strip()
+    bold = weight in ('bold', 'bolder') or (weight.isdigit() and int(weight) >= 600)
+    return (style.get('font-family', 'sans-serif'), bold, round(style['_font_px'] * scale))
+
+
+def _measure(runs):
+    total = 0.0
+    for run in runs:
+        if run[0] == 'text':
+            total += get_font(*run[2]).getlength(run[1])
+        else:
+            total += run[1]
+    return total
+
+
+# ---------- План отрисовки ----------
+
+class RenderPlan:
+    """Скомпилированный шаблон: статичный слой и персональные строки"""
+
+    def __init__(self, size, static_layer, dynamic_lines):
+        self.size = size
+        self.static_layer = static_layer
+        self.dynamic_lines = dynamic_lines
+
+    def render(self, user_name):
+        """Изображение для пользователя: копия статичного слоя и строки с именем"""
+        img = self.static_layer.copy()
+        if self.dynamic_lines:
+            draw = ImageDraw.Draw(img)
+            for runs, baseline, max_width in self.dynamic_lines:
+                personal = [
+                    ('text', run[1].replace(NAME_PLACEHOLDER, user_name), run[2], run[3]) if run[0] == 'text' else run
+                    for run in runs
+                ]
+                _draw_line(draw, self.size[0], personal, baseline, max_width)
+        return img
+
+
+def _fit_runs(runs, max_width):
+    """Уменьшает шрифты строки, если она не помещается по ширине"""
+    width = _measure(runs)
+    if width <= max_width or width <= 0:
+        return runs, width
+    factor = max_width / width
+    fitted = [
+        ('text', run[1], run[2][:2] + (max(int(run[2][2] * factor), 1),), run[3]) if run[0] == 'text'
+        else ('gap', run[1] * factor)
+        for run in runs
+    ]
+    return fitted, _measure(fitted)
+
+
+def _draw_line(draw, canvas_width, runs, baseline, max_width):
+    runs, width = _fit_runs(runs, max_width)
+    x = (canvas_width - width) / 2
+    for run in runs:
+        if run[0] == 'gap':
+            x += run[1]
+            continue
+        font = get_font(*run[2])
+        draw.text((x, baseline), run[1], font=font, fill=run[3], anchor='ls')
+        x += font.getlength(run[1])
+
+
+def _paint_box(layer, rect, box):
+    x0, y0, x1, y1 = (int(round(v)) for v in rect)
+    if x1 <= x0 or y1 <= y0:
+        return
+    radius = int(round(box.radius))
+    background = box.background
+    if background and background[0] == 'gradient':
+        box_size = (x1 - x0 + 1, y1 - y0 + 1)
+        mask = Image.new('L', box_size, 0)
+        ImageDraw.Draw(mask).rounded_rectangle((0, 0, x1 - x0, y1 - y0), radius=radius, fill=255)
+        layer.paste(gradient_image(box_size, background[1], background[2]), (x0, y0), mask)
+    overlay = Image.new('RGBA', layer.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    fill = background[1] if background and background[0] == 'color' else None
+    outline = box.border_color if box.border else None
+    draw.rounded_rectangle(
+        (x0, y0, x1, y1), radius=radius, fill=fill,
+        outline=outline, width=int(round(box.border)) if outline else 0
+    )
+    layer.alpha_composite(overlay)
+
+
+def _find_canvas(root):
+    """Элемент, фон которого становится фоном изображения: body или его первый дочерний блок"""
+    body = next((el for el in _walk(root) if el.tag == 'body'), None)
+    if body is None:
+        raise TemplateError("Template has no <body>")
+    children = [child for child in body.children if _is_block(child)]
+    if len(children) == 1 and children[0].style.get('background'):
+        return children[0]
+    return body
+
+
+def _walk(element):
+    yield element
+    for child in element.children:
+        if isinstance(child, _Element):
+            yield from _walk(child)
+
+
+def _layout_at(canvas, size, scale):
+    width, height = size
+    layout = _Layout(width, scale)
+    box = _Box(canvas.style, scale)
+    inset = box.border + max(box.padding[1], box.padding[3])
+    content_height = layout._stack(canvas, 0, width - 2 * inset, inset, box.gap) \
+        if any(_is_block(child) for child in canvas.children) \
+        else layout._text(canvas, 0, width - 2 * inset, inset)
+    vertical = box.padding[0] + box.padding[2] + 2 * box.border
+    return layout, content_height, vertical
+
+
+def compile_template(html, size=CANVAS_SIZE):
+    """Разбирает HTML шаблон и готовит план отрисовки"""
+    builder = _DomBuilder()
+    builder.feed(html)
+    builder.close()
+    rules = _parse_css(''.join(builder.css))
+    root_style = dict(TAG_DEFAULTS['body'])
+    root_style['_font_px'] = 16.0
+    for child in builder.root.children:
+        if isinstance(child, _Element):
+            _compute_styles(child, rules, root_style)
+    canvas = _find_canvas(builder.root)
+    width, height = size
+
+    # Шаблоны сверстаны в CSS пикселях, подбираем общий масштаб под холст
+    layout, content_height, vertical = _layout_at(canvas, size, 1.0)
+    scale = min(1.0, width / max(layout.required_width, 1), height / max(content_height + vertical, 1))
+    for _ in range(5):
+        layout, content_height, vertical = _layout_at(canvas, size, scale)
+        if layout.required_width <= width and content_height + vertical <= height:
+            break
+        scale *= 0.97
+
+    # Содержимое центрируется по вертикали
+    offset = (height - content_height) / 2
+    background = _parse_background(canvas.style.get('background'))
+    if background and background[0] == 'gradient':
+        layer = gradient_image(size, background[1], background[2]).convert('RGBA')
+    else:
+        layer = Image.new('RGBA', size, background[1] if background else (255, 255, 255, 255))
+
+    # Статичное содержимое рисуется один раз, строки с {{name}} откладываются
+    dynamic_lines = []
+    draw = ImageDraw.Draw(layer)
+    for op in layout.ops:
+        if op[0] == 'box':
+            x0, y0, x1, y1 = op[1]
+            _paint_box(layer, (x0, y0 + offset, x1, y1 + offset), op[2])
+            continue
+        _, runs, baseline, max_width, dynamic = op
+        if dynamic:
+            dynamic_lines.append((runs, baseline + offset, max_width))
+        else:
+            _draw_line(draw, width, runs, baseline + offset, max_width)
+    return RenderPlan(size, layer.convert('RGB'), dynamic_lines)
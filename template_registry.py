@@ -0,0 +1,71 @@
+import hashlib
+import re
+from pathlib import Path
+
+STAGE_FILE_RE = re.compile(r"^stage(\d+)_.*\.html$")
+
+
+class TemplateRegistry:
+    """HTML шаблоны этапов в памяти с перезагрузкой по mtime"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        # stage -> {'path', 'mtime', 'html', 'version'}
+        self._templates = {}
+        self.version = ""
+        self.reload()
+
+    def _scan(self):
+        """Возвращает {stage: (path, mtime)} для файлов шаблонов в каталоге"""
+        found = {}
+        for path in sorted(self.directory.glob("stage*_*.html")):
+            match = STAGE_FILE_RE.match(path.name)
+            if match is None:
+                continue
+            # Как и раньше, при нескольких файлах на этап берется первый
+            found.setdefault(int(match.group(1)), (path, path.stat().st_mtime_ns))
+        return found
+
+    def reload(self):
+        """Перечитывает все шаблоны с диска"""
+        templates = {}
+        for stage, (path, mtime) in self._scan().items():
+            html = path.read_text(encoding='utf-8')
+            templates[stage] = {
+                'path': path,
+                'mtime': mtime,
+                'html': html,
+                'version': hashlib.sha256(html.encode('utf-8')).hexdigest()[:16],
+            }
+        # Подменяем словарь целиком, чтобы читатели не видели промежуточного состояния
+        self._templates = templates
+        self.version = hashlib.sha256(
+            "".join(f"{stage}:{t['version']};" for stage, t in sorted(templates.items())).encode('utf-8')
+        ).hexdigest()[:16]
+        return sorted(templates)
+
+    def refresh(self):
+        """Перезагружает шаблоны, если файлы добавились, удалились или изменились"""
+        current = {stage: (t['path'], t['mtime']) for stage, t in self._templates.items()}
+        if self._scan() == current:
+            return False
+        self.reload()
+        return True
+
+    def get(self, stage):
+        """Возвращает HTML шаблона этапа"""
+        template = self._templates.get(stage)
+        if template is None:
+            raise FileNotFoundError(f"Template for stage {stage} not found")
+        return template['html']
+
+    def stage_version(self, stage):
+        """Хэш содержимого шаблона этапа"""
+        template = self._templates.get(stage)
+        if template is None:
+            raise FileNotFoundError(f"Template for stage {stage} not found")
+        return template['version']
+
+    @property
+    def stages(self):
+        return sorted(self._templates)
@@ -0,0 +1,165 @@
+"""Сквозные проверки бота с заглушкой Bot API из loadtest.py
+
+    python -m pytest -q
+
+Бот запускается отдельным процессом (как в loadtest.py) в режимах polling,
+webhook и с воркерами (BOT_WORKERS); проверяется, что /start возвращает фото первого этапа, а /stats
+отвечает администратору.
+"""
+import asyncio
+import signal
+import socket
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+
+from http_server import HttpServer
+from loadtest import FakeBotApi, start_bot
+
+TOKEN = '123456:TEST'
+ADMIN_ID = 42
+SECRET = 'test-secret'
+# Первый запуск бота включает рендер шаблонов
+TIMEOUT = 60
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def message_update(user_id, text):
+    sender = {'id': user_id, 'is_bot': False, 'first_name': 'Тест'}
+    return {'message': {
+        'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+        'from': sender, 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+    }}
+
+
+@asynccontextmanager
+async def running_bot(api, bot_env):
+    """Заглушка Bot API на HttpServer и бот, подключенный к ней"""
+    server = HttpServer('127.0.0.1', 0, max_body_size=64 * 1024 * 1024)
+    api.routes(server)
+    await server.start()
+    workdir = Path(tempfile.mkdtemp(prefix='funnel-test-'))
+    args = SimpleNamespace(token=TOKEN, bot_env=[f"ADMIN_IDS={ADMIN_ID}", *bot_env])
+    bot = await start_bot(args, f"http://127.0.0.1:{server.port}", workdir)
+    try:
+        yield bot
+    finally:
+        if bot.returncode is None:
+            bot.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(bot.wait(), 30)
+            except asyncio.TimeoutError:
+                bot.kill()
+        api.close()
+        await asyncio.sleep(0.1)
+        await server.stop()
+
+
+async def receive(api, chat_id):
+    """Следующее сообщение бота в чат: (тип, сообщение)"""
+    kind, _, message = await asyncio.wait_for(api.inbox(chat_id).get(), TIMEOUT)
+    return kind, message
+
+
+async def wait_health(client, url, bot):
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        assert bot.returncode is None, "бот завершился при запуске"
+        try:
+            response = await client.get(url)
+            if response.status_code == 200:
+                return response
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise AssertionError(f"{url} не ответил за {TIMEOUT} с")
+
+
+def test_polling_start_and_stats():
+    async def scenario():
+        api = FakeBotApi(TOKEN)
+        async with running_bot(api, []):
+            await asyncio.wait_for(api.polling.wait(), TIMEOUT)
+
+            api.push(message_update(1001, '/start'))
+            kind, message = await receive(api, 1001)
+            assert kind == 'photo'
+            assert message['reply_markup']['inline_keyboard']
+
+            api.push(message_update(ADMIN_ID, '/stats'))
+            kind, message = await receive(api, ADMIN_ID)
+            assert kind == 'text'
+            assert api.calls['getUpdates'] > 1
+
+    asyncio.run(scenario())
+
+
+def test_workers_start_and_stats():
+    async def scenario():
+        api = FakeBotApi(TOKEN)
+        async with running_bot(api, ['BOT_WORKERS=2']):
+            await asyncio.wait_for(api.polling.wait(), TIMEOUT)
+
+            # Нечетный id — воркер 1, четный и администратор — воркер 0
+            for user_id in (1001, 1002):
+                api.push(message_update(user_id, '/start'))
+            api.push(message_update(ADMIN_ID, '/stats'))
+            for user_id in (1001, 1002):
+                kind, message = await receive(api, user_id)
+                assert kind == 'photo'
+            kind, message = await receive(api, ADMIN_ID)
+            assert kind == 'text'
+
+    asyncio.run(scenario())
+
+
+def test_webhook_start_and_stats():
+    async def scenario():
+        api = FakeBotApi(TOKEN)
+        port = free_port()
+        base = f"http://127.0.0.1:{port}"
+        bot_env = [
+            'BOT_MODE=webhook', f"PORT={port}", 'WEBHOOK_LISTEN=127.0.0.1',
+            'WEBHOOK_URL=https://bot.example.com', 'WEBHOOK_PATH=/telegram', f"WEBHOOK_SECRET={SECRET}",
+        ]
+        async with running_bot(api, bot_env) as bot, httpx.AsyncClient(timeout=10) as client:
+            health = await wait_health(client, f"{base}/health", bot)
+            assert health.json()['status'] == 'ok'
+
+            update = {'update_id': 1, **message_update(1001, '/start')}
+            response = await client.post(
+                f"{base}/telegram", json=update,
+                headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}
+            )
+            assert response.status_code == 403
+
+            response = await client.post(
+                f"{base}/telegram", json=update,
+                headers={'X-Telegram-Bot-Api-Secret-Token': SECRET}
+            )
+            assert response.status_code == 200
+            kind, message = await receive(api, 1001)
+            assert kind == 'photo'
+
+            response = await client.post(
+                f"{base}/telegram", json={'update_id': 2, **message_update(ADMIN_ID, '/stats')},
+                headers={'X-Telegram-Bot-Api-Secret-Token': SECRET}
+            )
+            assert response.status_code == 200
+            kind, message = await receive(api, ADMIN_ID)
+            assert kind == 'text'
+            # В режиме webhook бот не должен опрашивать getUpdates
+            assert api.calls['setWebhook'] == 1
+            assert api.calls['getUpdates'] == 0
+
+    asyncio.run(scenario())
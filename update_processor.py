@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+log = logging.getLogger(__name__)
+
+
+def update_user_key(update):
+    """Ключ сериализации: пользователь (или чат) обновления"""
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+
+def callback_key(update):
+    """Ключ нажатия: кнопка (data) и сообщение, к которому она относится"""
+    query = update.callback_query if isinstance(update, Update) else None
+    if query is None:
+        return None
+    message_id = query.message.message_id if query.message is not None else query.inline_message_id
+    return query.data, message_id
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей
+
+    Обновления одного пользователя выполняются строго по очереди, поэтому
+    двойное нажатие «Далее» не обгоняет само себя. Если у пользователя уже
+    ждут max_pending_per_user обновлений, новые отбрасываются — это защищает
+    общий лимит max_concurrent_updates от одного «залипшего» пользователя.
+
+    Повторные нажатия той же кнопки, пока первое еще обрабатывается,
+    схлопываются: на них сразу отвечается пустым answer, без обработчика.
+    """
+
+    def __init__(self, max_concurrent_updates=256, max_pending_per_user=4):
+        super().__init__(max_concurrent_updates)
+        self.max_pending_per_user = max_pending_per_user
+        # ключ -> [блокировка, число обновлений в работе и в ожидании, нажатия в работе]
+        self._users = {}
+
+    @classmethod
+    def from_env(cls):
+        """Создает процессор по переменным UPDATE_CONCURRENCY / UPDATE_PENDING_PER_USER"""
+        return cls(
+            max_concurrent_updates=int(os.getenv("UPDATE_CONCURRENCY", "256")),
+            max_pending_per_user=int(os.getenv("UPDATE_PENDING_PER_USER", "4")),
+        )
+
+    async def do_process_update(self, update, coroutine):
+        key = update_user_key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0, set()]
+        if entry[1] >= self.max_pending_per_user:
+            # Корутину нужно закрыть, иначе asyncio предупредит о неожиданном await
+            coroutine.close()
+            log.debug("Пропущено обновление: очередь пользователя переполнена", extra={'user_id': key})
+            return
+        press = callback_key(update)
+        if press is not None and press in entry[2]:
+            coroutine.close()
+            log.debug("Повторное нажатие схлопнуто", extra={'user_id': key})
+            await self._answer(update.callback_query)
+            return
+        if press is not None:
+            entry[2].add(press)
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            entry[2].discard(press)
+            if entry[1] == 0:
+                # Записи без обновлений не храним
+                self._users.pop(key, None)
+
+    @staticmethod
+    async def _answer(query):
+        # Убирает «часики» на кнопке у схлопнутого нажатия
+        try:
+            await query.answer()
+        except TelegramError as e:
+            log.debug("Не удалось ответить на нажатие: %s", e)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
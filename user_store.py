@@ -0,0 +1,750 @@
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+CSV_FIELDS = ['name', 'telegram_id', 'current_stage']
+
+log = logging.getLogger(__name__)
+
+
+class UserStore:
+    """Хранилище пользователей воронки"""
+
+    # Хранит таймеры автоотправки (schedule_next, due_users, claim_due)
+    has_timers = False
+    # Ведет счетчики входов в этапы (stage_entries, daily_stage_entries)
+    has_stats = False
+
+    def save_user(self, user_data):
+        """Создает или обновляет пользователя (name, telegram_id, current_stage)"""
+        raise NotImplementedError
+
+    def get_user(self, telegram_id):
+        """Пользователь в виде словаря (name, telegram_id, current_stage) или None"""
+        raise NotImplementedError
+
+    def get_user_stage(self, telegram_id):
+        """Возвращает текущий этап пользователя (1, если пользователь не найден)"""
+        raise NotImplementedError
+
+    def update_user_stage(self, telegram_id, stage):
+        """Обновляет этап пользователя"""
+        raise NotImplementedError
+
+    def compare_and_set_stage(self, telegram_id, expected_stage, stage, name=None):
+        """Атомарно меняет этап, только если текущий равен expected_stage
+
+        Отсутствующий пользователь считается находящимся на этапе 1 и создается
+        с именем name. Возвращает True, если этап изменен. Переход вперед
+        считается входом в этап stage, откат (stage < expected_stage) после
+        неудачной отправки этот вход отменяет.
+        """
+        raise NotImplementedError
+
+    def iter_users(self):
+        """Перебирает всех пользователей в виде словарей"""
+        raise NotImplementedError
+
+    def schedule_next(self, telegram_id, at):
+        """Запоминает время следующей автоматической отправки (None — отменить)"""
+        raise NotImplementedError
+
+    def due_users(self, since, until, limit, after_id=None):
+        """Таймеры с since <= next_send_at < until по порядку (next_send_at, telegram_id)
+
+        since=None — без нижней границы; after_id — продолжить после (since, after_id).
+        """
+        raise NotImplementedError
+
+    def claim_due(self, telegram_id, at):
+        """Атомарно снимает таймер, если он все еще равен at; True — можно отправлять"""
+        raise NotImplementedError
+
+    def stage_entries(self, day=None):
+        """Сколько раз пользователи входили в каждый этап: {этап: число}
+
+        day — 'YYYY-MM-DD' (UTC) или None — за все время. Счетчики обновляются
+        при каждом переходе, поэтому чтение не зависит от числа пользователей.
+        """
+        raise NotImplementedError
+
+    def daily_stage_entries(self, since_day):
+        """Входы в этапы по дням начиная с since_day: {день: {этап: число}}"""
+        raise NotImplementedError
+
+    def apply_batch(self, users, timers, entries):
+        """Записывает накопленные изменения разом
+
+        users — {telegram_id: (имя, этап)}, timers — {telegram_id: next_send_at
+        или None}, entries — {(день, этап): сколько входов добавить}.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Освобождает ресурсы хранилища"""
+
+
+class CsvUserStore(UserStore):
+    """Старое хранилище: весь файл перечитывается и перезаписывается на каждый вызов"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+        # Создаем CSV файл с заголовками если его нет
+        if not self.path.exists():
+            with open(self.path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(CSV_FIELDS)
+
+    def _read_all(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return list(csv.DictReader(f))
+
+    def _write_all(self, users):
+        with open(self.path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(users)
+
+    def save_user(self, user_data):
+        with self._lock:
+            users = []
+            user_exists = False
+
+            try:
+                for row in self._read_all():
+                    users.append(row)
+                    if row['telegram_id'] == str(user_data['telegram_id']):
+                        user_exists = True
+                        # Обновляем данные
+                        row['name'] = user_data['name']
+                        row['current_stage'] = user_data.get('current_stage', 1)
+            except FileNotFoundError:
+                pass
+
+            # Если пользователь новый, добавляем его
+            if not user_exists:
+                users.append({
+                    'name': user_data['name'],
+                    'telegram_id': user_data['telegram_id'],
+                    'current_stage': user_data.get('current_stage', 1)
+                })
+
+            self._write_all(users)
+
+    def get_user(self, telegram_id):
+        # Под блокировкой: файл может переписываться из потока записи кэша
+        with self._lock:
+            try:
+                for row in self._read_all():
+                    if row['telegram_id'] == str(telegram_id):
+                        return {
+                            'name': row['name'],
+                            'telegram_id': row['telegram_id'],
+                            'current_stage': int(row.get('current_stage') or 1)
+                        }
+            except FileNotFoundError:
+                pass
+        return None
+
+    def get_user_stage(self, telegram_id):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    if row['telegram_id'] == str(telegram_id):
+                        return int(row.get('current_stage') or 1)
+        except FileNotFoundError:
+            pass
+        return 1
+
+    def update_user_stage(self, telegram_id, stage):
+        with self._lock:
+            users = self._read_all()
+            for row in users:
+                if row['telegram_id'] == str(telegram_id):
+                    row['current_stage'] = stage
+            self._write_all(users)
+
+    def compare_and_set_stage(self, telegram_id, expected_stage, stage, name=None):
+        with self._lock:
+            users = self._read_all()
+            for row in users:
+                if row['telegram_id'] == str(telegram_id):
+                    if int(row.get('current_stage') or 1) != expected_stage:
+                        return False
+                    row['current_stage'] = stage
+                    break
+            else:
+                if expected_stage != 1 or name is None:
+                    return False
+                users.append({'name': name, 'telegram_id': telegram_id, 'current_stage': stage})
+            self._write_all(users)
+            return True
+
+    def iter_users(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    yield {
+                        'name': row['name'],
+                        'telegram_id': row['telegram_id'],
+                        'current_stage': int(row.get('current_stage') or 1)
+                    }
+        except FileNotFoundError:
+            return
+
+    def apply_batch(self, users, timers, entries):
+        # Таймеров и счетчиков в CSV нет; файл переписывается один раз на пачку
+        if not users:
+            return
+        with self._lock:
+            pending = {str(telegram_id): user for telegram_id, user in users.items()}
+            rows = self._read_all()
+            for row in rows:
+                user = pending.pop(row['telegram_id'], None)
+                if user is not None:
+                    row['name'], row['current_stage'] = user
+            for telegram_id, (name, stage) in pending.items():
+                rows.append({'name': name, 'telegram_id': telegram_id, 'current_stage': stage})
+            self._write_all(rows)
+
+
+class SqliteUserStore(UserStore):
+    """Хранилище на SQLite (WAL) с первичным ключом по telegram_id"""
+
+    has_timers = True
+    has_stats = True
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # Соединение общее для всех потоков, доступ сериализуется блокировкой
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            # Воркеры многопроцессного режима открывают базу одновременно
+            with self._transaction():
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS users (
+                        telegram_id INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        current_stage INTEGER NOT NULL DEFAULT 1
+                    )
+                """)
+                self._migrate()
+
+    @contextmanager
+    def _transaction(self):
+        # Вызывается под блокировкой
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _migrate(self):
+        """Добавляет колонки и таблицы, появившиеся после создания базы"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if 'next_send_at' not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN next_send_at REAL")
+        # Частичный индекс: в нем только пользователи с активным таймером
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_next_send_at ON users(next_send_at) "
+            "WHERE next_send_at IS NOT NULL"
+        )
+        # Счетчики входов в этапы: day = 'YYYY-MM-DD' (UTC), '' — за все время
+        tables = {row[0] for row in self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'stage_entries' not in tables:
+            self._conn.execute("""
+                CREATE TABLE stage_entries (
+                    day TEXT NOT NULL,
+                    stage INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (day, stage)
+                ) WITHOUT ROWID
+            """)
+            self._backfill_stage_entries()
+
+    def _backfill_stage_entries(self):
+        """Счетчики за все время по текущим этапам (для базы, созданной до счетчиков)
+
+        Истории переходов нет, поэтому считается, что пользователь на этапе N
+        прошел через все этапы до N.
+        """
+        stages = self._conn.execute(
+            "SELECT current_stage, COUNT(*) FROM users GROUP BY current_stage"
+        ).fetchall()
+        self._add_passed_stages(stages)
+
+    def _add_passed_stages(self, stages):
+        """Добавляет к счетчикам за все время этапы 1..N для пар (N, число пользователей)"""
+        entries = {}
+        for current_stage, count in stages:
+            for stage in range(1, int(current_stage) + 1):
+                entries[stage] = entries.get(stage, 0) + count
+        self._conn.executemany(
+            "INSERT INTO stage_entries (day, stage, count) VALUES ('', ?, ?) "
+            "ON CONFLICT(day, stage) DO UPDATE SET count = count + excluded.count",
+            sorted(entries.items())
+        )
+
+    def _count_entry(self, stage):
+        # Вызывается в транзакции перехода: счетчик за сегодня и за все время
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        self._conn.executemany(
+            "INSERT INTO stage_entries (day, stage, count) VALUES (?, ?, 1) "
+            "ON CONFLICT(day, stage) DO UPDATE SET count = count + 1",
+            ((day, int(stage)), ('', int(stage)))
+        )
+
+    def _uncount_entry(self, stage):
+        # Откат перехода; после полуночи UTC вход остается в счетчике прошлого дня
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        self._conn.executemany(
+            "UPDATE stage_entries SET count = count - 1 WHERE day = ? AND stage = ? AND count > 0",
+            ((day, int(stage)), ('', int(stage)))
+        )
+
+    def save_user(self, user_data):
+        stage = int(user_data.get('current_stage', 1))
+        with self._lock, self._transaction():
+            self._conn.execute(
+                """
+                INSERT INTO users (telegram_id, name, current_stage) VALUES (?, ?, ?)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    name = excluded.name,
+                    current_stage = excluded.current_stage
+                """,
+                (int(user_data['telegram_id']), user_data['name'], stage)
+            )
+            # /start существующего пользователя — новый проход воронки
+            self._count_entry(stage)
+
+    def get_user(self, telegram_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, current_stage FROM users WHERE telegram_id = ?",
+                (int(telegram_id),)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'name': row[0], 'telegram_id': str(telegram_id), 'current_stage': row[1]}
+
+    def get_user_stage(self, telegram_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT current_stage FROM users WHERE telegram_id = ?",
+                (int(telegram_id),)
+            ).fetchone()
+        return row[0] if row else 1
+
+    def update_user_stage(self, telegram_id, stage):
+        with self._lock, self._transaction():
+            cursor = self._conn.execute(
+                "UPDATE users SET current_stage = ? WHERE telegram_id = ? AND current_stage != ?",
+                (int(stage), int(telegram_id), int(stage))
+            )
+            if cursor.rowcount == 1:
+                self._count_entry(stage)
+
+    def compare_and_set_stage(self, telegram_id, expected_stage, stage, name=None):
+        with self._lock, self._transaction():
+            if expected_stage == 1 and name is not None:
+                # Новый пользователь вставляется, существующий обновляется только с этапа 1
+                cursor = self._conn.execute(
+                    """
+                    INSERT INTO users (telegram_id, name, current_stage) VALUES (?, ?, ?)
+                    ON CONFLICT(telegram_id) DO UPDATE SET current_stage = excluded.current_stage
+                    WHERE users.current_stage = 1
+                    """,
+                    (int(telegram_id), name, int(stage))
+                )
+            else:
+                cursor = self._conn.execute(
+                    "UPDATE users SET current_stage = ? WHERE telegram_id = ? AND current_stage = ?",
+                    (int(stage), int(telegram_id), int(expected_stage))
+                )
+            if cursor.rowcount != 1:
+                return False
+            if stage > expected_stage:
+                self._count_entry(stage)
+            elif stage < expected_stage:
+                # Откат неудачной отправки: вход в expected_stage не состоялся
+                self._uncount_entry(expected_stage)
+            return True
+
+    def iter_users(self):
+        # Читаем страницами по первичному ключу, чтобы не держать блокировку
+        last_id = None
+        while True:
+            with self._lock:
+                if last_id is None:
+                    rows = self._conn.execute(
+                        "SELECT telegram_id, name, current_stage FROM users "
+                        "ORDER BY telegram_id LIMIT 1000"
+                    ).fetchall()
+                else:
+                    rows = self._conn.execute(
+                        "SELECT telegram_id, name, current_stage FROM users "
+                        "WHERE telegram_id > ? ORDER BY telegram_id LIMIT 1000",
+                        (last_id,)
+                    ).fetchall()
+            if not rows:
+                return
+            for telegram_id, name, stage in rows:
+                yield {'name': name, 'telegram_id': str(telegram_id), 'current_stage': stage}
+            last_id = rows[-1][0]
+
+    def schedule_next(self, telegram_id, at):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE users SET next_send_at = ? WHERE telegram_id = ?",
+                (at, int(telegram_id))
+            )
+
+    def due_users(self, since, until, limit, after_id=None):
+        query = (
+            "SELECT telegram_id, name, current_stage, next_send_at FROM users "
+            "WHERE next_send_at IS NOT NULL AND next_send_at < ?"
+        )
+        params = [until]
+        if since is not None and after_id is not None:
+            query += " AND (next_send_at, telegram_id) > (?, ?)"
+            params.extend((since, int(after_id)))
+        elif since is not None:
+            query += " AND next_send_at >= ?"
+            params.append(since)
+        query += " ORDER BY next_send_at, telegram_id LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {'telegram_id': str(telegram_id), 'name': name, 'current_stage': stage, 'next_send_at': at}
+            for telegram_id, name, stage, at in rows
+        ]
+
+    def claim_due(self, telegram_id, at):
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE users SET next_send_at = NULL WHERE telegram_id = ? AND next_send_at = ?",
+                (int(telegram_id), at)
+            )
+            return cursor.rowcount == 1
+
+    def import_csv(self, csv_path):
+        """Одноразово переносит пользователей из CSV файла, возвращает их количество"""
+        with open(csv_path, 'r', encoding='utf-8') as f:
+            rows = [
+                (int(row['telegram_id']), row['name'], int(row.get('current_stage') or 1))
+                for row in csv.DictReader(f)
+                if row.get('telegram_id')
+            ]
+        # В счетчики входов попадают только новые пользователи (с последним этапом из файла)
+        stages = {telegram_id: stage for telegram_id, _, stage in rows}
+        with self._lock, self._transaction():
+            new_stages = [
+                stage for telegram_id, stage in stages.items()
+                if self._conn.execute(
+                    "SELECT 1 FROM users WHERE telegram_id = ?", (telegram_id,)
+                ).fetchone() is None
+            ]
+            self._conn.executemany(
+                """
+                INSERT INTO users (telegram_id, name, current_stage) VALUES (?, ?, ?)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    name = excluded.name,
+                    current_stage = excluded.current_stage
+                """,
+                rows
+            )
+            self._add_passed_stages((stage, 1) for stage in new_stages)
+        return len(rows)
+
+    def stage_entries(self, day=None):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, count FROM stage_entries WHERE day = ? ORDER BY stage",
+                (day or '',)
+            ).fetchall()
+        return dict(rows)
+
+    def daily_stage_entries(self, since_day):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, stage, count FROM stage_entries WHERE day >= ? ORDER BY day, stage",
+                (since_day,)
+            ).fetchall()
+        days = {}
+        for day, stage, count in rows:
+            days.setdefault(day, {})[stage] = count
+        return days
+
+    def apply_batch(self, users, timers, entries):
+        # Счетчики за все время — сумма по дням пачки
+        totals = {}
+        for (day, stage), count in entries.items():
+            totals[stage] = totals.get(stage, 0) + count
+        with self._lock, self._transaction():
+            self._conn.executemany(
+                """
+                INSERT INTO users (telegram_id, name, current_stage) VALUES (?, ?, ?)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    name = excluded.name,
+                    current_stage = excluded.current_stage
+                """,
+                ((int(telegram_id), name, int(stage)) for telegram_id, (name, stage) in users.items())
+            )
+            self._conn.executemany(
+                "UPDATE users SET next_send_at = ? WHERE telegram_id = ?",
+                ((at, int(telegram_id)) for telegram_id, at in timers.items())
+            )
+            rows = (
+                [(day, int(stage), count) for (day, stage), count in entries.items()]
+                + [('', int(stage), count) for stage, count in totals.items()]
+            )
+            self._conn.executemany(
+                "INSERT INTO stage_entries (day, stage, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(day, stage) DO UPDATE SET count = count + excluded.count",
+                [row for row in rows if row[2] > 0]
+            )
+            # Откаты переходов, посчитанных в прошлых пачках
+            self._conn.executemany(
+                "UPDATE stage_entries SET count = MAX(count + ?, 0) WHERE day = ? AND stage = ?",
+                [(count, day, stage) for day, stage, count in rows if count < 0]
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedUserStore(UserStore):
+    """Кэш пользователей в памяти перед хранилищем с отложенной записью
+
+    Чтения отдаются из LRU кэша на max_size пользователей (запись — кортеж
+    (имя, этап)), изменения этапов, таймеров и счетчиков копятся и раз в
+    flush_interval секунд уходят в хранилище одной пачкой из фонового
+    потока. При аварийном завершении теряется не больше flush_interval
+    секунд изменений; close() записывает все.
+
+    Кэш считает себя единственным, кто меняет пользователей: при нескольких
+    процессах над одной базой он бы перезаписывал чужие изменения.
+    """
+
+    def __init__(self, store, max_size=10000, flush_interval=1.0):
+        self.store = store
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        # telegram_id -> (имя, этап) или None, если пользователя нет
+        self._entries = OrderedDict()
+        # Еще не записанные изменения
+        self._dirty = {}
+        self._timers = {}
+        self._counts = {}
+        # Пачка, которая сейчас записывается: чтения видят ее до коммита
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name='user-store-flush', daemon=True)
+        self._thread.start()
+
+    @property
+    def has_timers(self):
+        return self.store.has_timers
+
+    @property
+    def has_stats(self):
+        return self.store.has_stats
+
+    @property
+    def pending(self):
+        """Сколько пользователей ждут записи"""
+        return len(self._dirty)
+
+    def _entry(self, telegram_id):
+        # Вызывается под блокировкой; промах читает хранилище
+        if telegram_id in self._entries:
+            self._entries.move_to_end(telegram_id)
+            return self._entries[telegram_id]
+        if telegram_id in self._dirty:
+            entry = self._dirty[telegram_id]
+        elif telegram_id in self._flushing:
+            entry = self._flushing[telegram_id]
+        else:
+            user = self.store.get_user(telegram_id)
+            entry = (user['name'], user['current_stage']) if user else None
+        self._remember(telegram_id, entry)
+        return entry
+
+    def _remember(self, telegram_id, entry):
+        self._entries[telegram_id] = entry
+        self._entries.move_to_end(telegram_id)
+        # Вытесненные изменения остаются в _dirty до записи
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _set(self, telegram_id, entry):
+        self._remember(telegram_id, entry)
+        self._dirty[telegram_id] = entry
+
+    def _count_entry(self, stage, delta=1):
+        key = (time.strftime('%Y-%m-%d', time.gmtime()), int(stage))
+        self._counts[key] = self._counts.get(key, 0) + delta
+
+    def save_user(self, user_data):
+        stage = int(user_data.get('current_stage', 1))
+        with self._lock:
+            self._set(int(user_data['telegram_id']), (user_data['name'], stage))
+            self._count_entry(stage)
+
+    def get_user(self, telegram_id):
+        with self._lock:
+            entry = self._entry(int(telegram_id))
+        if entry is None:
+            return None
+        return {'name': entry[0], 'telegram_id': str(telegram_id), 'current_stage': entry[1]}
+
+    def get_user_stage(self, telegram_id):
+        with self._lock:
+            entry = self._entry(int(telegram_id))
+        return entry[1] if entry else 1
+
+    def update_user_stage(self, telegram_id, stage):
+        with self._lock:
+            entry = self._entry(int(telegram_id))
+            if entry is None or entry[1] == int(stage):
+                return
+            self._set(int(telegram_id), (entry[0], int(stage)))
+            self._count_entry(stage)
+
+    def compare_and_set_stage(self, telegram_id, expected_stage, stage, name=None):
+        with self._lock:
+            entry = self._entry(int(telegram_id))
+            if entry is None:
+                if expected_stage != 1 or name is None:
+                    return False
+                entry = (name, 1)
+            if entry[1] != expected_stage:
+                return False
+            self._set(int(telegram_id), (entry[0], int(stage)))
+            if stage > expected_stage:
+                self._count_entry(stage)
+            elif stage < expected_stage:
+                self._count_entry(expected_stage, -1)
+            return True
+
+    def schedule_next(self, telegram_id, at):
+        with self._lock:
+            self._timers[int(telegram_id)] = at
+
+    # Выборки по всей базе сначала записывают накопленное
+
+    def iter_users(self):
+        self.flush()
+        yield from self.store.iter_users()
+
+    def due_users(self, since, until, limit, after_id=None):
+        self.flush()
+        return self.store.due_users(since, until, limit, after_id)
+
+    def claim_due(self, telegram_id, at):
+        self.flush()
+        return self.store.claim_due(telegram_id, at)
+
+    def stage_entries(self, day=None):
+        self.flush()
+        return self.store.stage_entries(day)
+
+    def daily_stage_entries(self, since_day):
+        self.flush()
+        return self.store.daily_stage_entries(since_day)
+
+    def flush(self):
+        """Записывает накопленные изменения в хранилище, возвращает число пользователей"""
+        with self._flush_lock:
+            with self._lock:
+                if not (self._dirty or self._timers or self._counts):
+                    return 0
+                users, timers, counts = self._dirty, self._timers, self._counts
+                self._dirty, self._timers, self._counts = {}, {}, {}
+                self._flushing = users
+            try:
+                self.store.apply_batch(users, timers, counts)
+            except Exception:
+                # Пачка вернется в следующую запись; более новые изменения важнее
+                with self._lock:
+                    self._dirty = {**users, **self._dirty}
+                    self._timers = {**timers, **self._timers}
+                    for key, count in counts.items():
+                        self._counts[key] = self._counts.get(key, 0) + count
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+        return len(users)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("✗ Ошибка записи пользователей: %s", e)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.flush()
+        except Exception as e:
+            log.error("✗ Не удалось записать пользователей при остановке: %s", e)
+        self.store.close()
+
+
+def create_user_store(cache=True):
+    """Создает хранилище по переменным окружения USER_STORE / USER_DB_PATH / USER_CSV_PATH
+
+    С cache=True и USER_CACHE_SIZE > 0 хранилище оборачивается в CachedUserStore.
+    """
+    kind = os.getenv("USER_STORE", "sqlite")
+    csv_path = Path(os.getenv("USER_CSV_PATH", "users_data.csv"))
+
+    if kind == 'csv':
+        store = CsvUserStore(csv_path)
+    elif kind == 'sqlite':
+        db_path = Path(os.getenv("USER_DB_PATH", "users.db"))
+        is_new = not db_path.exists()
+        store = SqliteUserStore(db_path)
+
+        # При первом запуске переносим данные из старого CSV
+        if is_new and csv_path.exists():
+            count = store.import_csv(csv_path)
+            log.info("✓ Импортировано пользователей из %s: %s", csv_path, count)
+    else:
+        raise ValueError(f"Unknown user store: {kind}")
+
+    cache_size = int(os.getenv("USER_CACHE_SIZE", "10000"))
+    if cache and cache_size > 0:
+        store = CachedUserStore(store, cache_size, float(os.getenv("USER_CACHE_FLUSH_INTERVAL", "1")))
+    return store
+
+
+if __name__ == "__main__":
+    # python user_store.py users_data.csv users.db
+    if len(sys.argv) != 3:
+        print("Usage: python user_store.py <users_data.csv> <users.db>")
+        sys.exit(1)
+    store = SqliteUserStore(sys.argv[2])
+    print(f"✓ Импортировано пользователей: {store.import_csv(sys.argv[1])}")
+    store.close()